@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import pathlib
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import statistics
+import litellm
+from typing import Any, Dict, List
+
+BASE_DIR = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(BASE_DIR.parent))
+
+from frontogether.agent import Agent
+from frontogether.workspace import Workspace
+from benchmarks.stub_server import StubServer, load
+
+SCENARIOS = ["text_only", "multi_file", "chained"]
+
+# litellm calls are wrapped to split the time spent in the agent loop
+# from the time spent waiting for the stream
+class Probe:
+    def __init__(self):
+        self.reset()
+        self._acompletion = litellm.acompletion
+        self._stream_chunk_builder = litellm.stream_chunk_builder
+
+    def reset(self) -> None:
+        self.chunks = 0
+        self.processing = 0.0
+        self.builder = 0.0
+        self.first_token = None
+
+    def install(self) -> None:
+        probe = self
+
+        async def acompletion(*args, **kwargs):
+            return Stream(probe, await probe._acompletion(*args, **kwargs))
+
+        def stream_chunk_builder(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return probe._stream_chunk_builder(*args, **kwargs)
+            finally:
+                probe.builder += time.perf_counter() - start
+
+        litellm.acompletion = acompletion
+        litellm.stream_chunk_builder = stream_chunk_builder
+
+    def uninstall(self) -> None:
+        litellm.acompletion = self._acompletion
+        litellm.stream_chunk_builder = self._stream_chunk_builder
+
+class Stream:
+    def __init__(self, probe: Probe, resp: Any):
+        self._probe = probe
+        self._resp = resp
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        it = self._resp.__aiter__()
+        while True:
+            try:
+                chunk = await it.__anext__()
+            except StopAsyncIteration:
+                return
+            # time until the loop asks for the next chunk
+            start = time.perf_counter()
+            yield chunk
+            self._probe.processing += time.perf_counter() - start
+            self._probe.chunks += 1
+
+async def run_turn(agent: Agent, probe: Probe, prompt: str) -> Dict[str, float]:
+    probe.reset()
+    start = time.perf_counter()
+
+    def first(msg: str):
+        if probe.first_token is None:
+            probe.first_token = time.perf_counter() - start
+
+    await agent.aanswer(prompt, progress_callback=first, progress_tool_callback=first)
+    return {
+        "latency": time.perf_counter() - start,
+        "ttft": probe.first_token or 0.0,
+        "chunks": probe.chunks,
+        "chunk_overhead_us": probe.processing / max(probe.chunks, 1) * 1e6,
+        "chunk_builder": probe.builder,
+    }
+
+def _memory(trace: bool) -> int:
+    # tracemalloc is exact but slows the loop down several times, peak
+    # rss is free and good enough to spot growth across a session
+    if trace:
+        return tracemalloc.get_traced_memory()[0]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def run_scenario(name: str, turns: int, latency: float, trace: bool) -> Dict[str, Any]:
+    recording = load(BASE_DIR.joinpath("recordings", f"{name}.json"))
+    probe = Probe()
+    probe.install()
+    try:
+        with StubServer(recording, latency=latency) as stub, tempfile.TemporaryDirectory() as workdir:
+            agent = Agent(model="openai/stub", api_base=stub.url, workspace=Workspace(pathlib.Path(workdir)))
+
+            if trace:
+                tracemalloc.start()
+            results = []
+            memory = []
+            for i in range(turns):
+                results.append(await run_turn(agent, probe, f"turn {i}: adjust the page"))
+                memory.append(_memory(trace))
+            if trace:
+                tracemalloc.stop()
+    finally:
+        probe.uninstall()
+
+    def median(key: str) -> float:
+        return statistics.median(r[key] for r in results)
+
+    return {
+        "scenario": name,
+        "turns": turns,
+        "ttft_ms": median("ttft") * 1e3,
+        "latency_ms": median("latency") * 1e3,
+        "first_latency_ms": results[0]["latency"] * 1e3,
+        "last_latency_ms": results[-1]["latency"] * 1e3,
+        "chunks": median("chunks"),
+        "chunk_overhead_us": median("chunk_overhead_us"),
+        "chunk_builder_ms": median("chunk_builder") * 1e3,
+        "memory_growth_kb": (memory[-1] - memory[0]) / 1024,
+    }
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    keys = ["ttft_ms", "latency_ms", "chunk_overhead_us", "chunk_builder_ms", "memory_growth_kb"]
+    previous = {b["scenario"]: b for b in baseline}
+    regressions = []
+    for r in results:
+        b = previous.get(r["scenario"])
+        if not b:
+            continue
+        for key in keys:
+            if b[key] > 0 and r[key] > b[key] * (1 + tolerance):
+                regressions.append(f"{r['scenario']}.{key}: {b[key]:.2f} -> {r[key]:.2f}")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="replay recorded responses through the agent loop")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated time to first token of the stub, in seconds")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="measure memory with tracemalloc instead of peak rss, timings are not meaningful")
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="fail when results are worse than this json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    results = []
+    for name in args.scenario or SCENARIOS:
+        res = asyncio.run(run_scenario(name, args.turns, args.latency, args.tracemalloc))
+        results.append(res)
+        print(" ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in res.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"regression: {r}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import pathlib
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Dict, List, Optional
+
+BASE_DIR = pathlib.Path(__file__).parent.resolve()
+
+# every probe runs in a fresh interpreter and prints the seconds it took,
+# nothing is cached in sys.modules between runs
+PROBES = {
+    "import_agent": """
+import time
+start = time.perf_counter()
+import frontogether.agent
+print(time.perf_counter() - start)
+""",
+    "agent": """
+import time, pathlib
+start = time.perf_counter()
+from frontogether.agent import Agent
+from frontogether.store import SessionStore
+store = SessionStore(pathlib.Path(".frontogether", "sessions.db"))
+Agent(store=store, session=store.latest(pathlib.Path.cwd()))
+print(time.perf_counter() - start)
+""",
+    # until the window is shown, the server and the web engine are
+    # started afterwards
+    "window": """
+import os, time
+start = time.perf_counter()
+from PySide6.QtWidgets import QApplication
+from frontogether.gui import Frontogether
+app = QApplication([])
+Frontogether(port=0).open(".")
+app.processEvents()
+print(time.perf_counter() - start, flush=True)
+os._exit(0)
+""",
+}
+
+# seconds, the median has to stay below
+BUDGETS = {
+    "import_agent": 0.5,
+    "agent": 0.8,
+    "window": 1.5,
+}
+
+def available(name: str) -> bool:
+    if name != "window":
+        return True
+    try:
+        import PySide6.QtWidgets
+    except ImportError:
+        return False
+    return True
+
+def run_probe(name: str, cwd: pathlib.Path) -> Optional[float]:
+    env = dict(os.environ, PYTHONPATH=str(BASE_DIR.parent), QT_QPA_PLATFORM="offscreen")
+    proc = subprocess.run([sys.executable, "-c", PROBES[name]], cwd=cwd, env=env,
+                          capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        return None
+    return float(proc.stdout.strip().splitlines()[-1])
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="time imports and startup in fresh interpreters")
+    parser.add_argument("--probe", action="append", choices=list(PROBES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write results as json")
+    args = parser.parse_args()
+
+    results: List[Dict[str, float]] = []
+    failed = []
+    with tempfile.TemporaryDirectory() as d:
+        for name in args.probe or list(PROBES):
+            if not available(name):
+                print(f"{name}: skipped, PySide6 is not installed")
+                continue
+            times = [run_probe(name, pathlib.Path(d)) for _ in range(args.repeat)]
+            if None in times:
+                failed.append(f"{name}: probe failed")
+                continue
+            median = statistics.median(times)
+            results.append({"probe": name, "median_ms": median * 1000, "max_ms": max(times) * 1000,
+                            "budget_ms": BUDGETS[name] * 1000})
+            print(f"{name}: median={median * 1000:.0f}ms max={max(times) * 1000:.0f}ms "
+                  f"budget={BUDGETS[name] * 1000:.0f}ms")
+            if median > BUDGETS[name]:
+                failed.append(f"{name}: {median * 1000:.0f}ms over budget")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    for f in failed:
+        print(f"failed: {f}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import json
+import time
+import logging
+import argparse
+import threading
+import http.server
+from functools import partial
+from typing import Any, Dict, List
+
+# openai compatible endpoint replaying recorded streaming responses. a
+# recording is a list of steps, one per model call of a turn. the step is
+# chosen by counting the assistant messages after the last user message,
+# so chained tool rounds replay in order.
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+def _step(recording: Dict[str, Any], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    index = 0
+    for m in messages:
+        if m.get("role") == "user":
+            index = 0
+        elif m.get("role") == "assistant":
+            index += 1
+    steps = recording["steps"]
+    return steps[min(index, len(steps) - 1)]
+
+def _pieces(text: str, size: int) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def chunks(step: Dict[str, Any], chunk_size: int) -> List[Dict[str, Any]]:
+    deltas = [{"role": "assistant", "content": ""}]
+    deltas += [{"content": piece} for piece in _pieces(step.get("content", ""), chunk_size)]
+    for i, tool_call in enumerate(step.get("tool_calls", [])):
+        deltas.append({"tool_calls": [{
+            "index": i,
+            "id": f"call_{i}",
+            "type": "function",
+            "function": {"name": tool_call["name"], "arguments": ""},
+        }]})
+        arguments = json.dumps(tool_call["arguments"])
+        for piece in _pieces(arguments, chunk_size):
+            deltas.append({"tool_calls": [{"index": i, "function": {"arguments": piece}}]})
+
+    finish = "tool_calls" if step.get("tool_calls") else "stop"
+    res = [{"choices": [{"index": 0, "delta": d, "finish_reason": None}]} for d in deltas]
+    res.append({"choices": [{"index": 0, "delta": {}, "finish_reason": finish}]})
+    return res
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, recording: Dict[str, Any], latency: float, **kwargs):
+        self._recording = recording
+        self._latency = latency
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        logging.debug("stub: " + format, *args)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        step = _step(self._recording, body["messages"])
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+
+        # time to first token of the simulated provider
+        time.sleep(self._latency)
+        for chunk in chunks(step, self._recording.get("chunk_size", 16)):
+            chunk.update({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": body["model"],
+            })
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if body.get("stream_options", {}).get("include_usage"):
+            usage = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": body["model"],
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": 0,
+                    "total_tokens": prompt_tokens,
+                },
+            }
+            self.wfile.write(f"data: {json.dumps(usage)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+class StubServer:
+    def __init__(self, recording: Dict[str, Any], port: int = 0, latency: float = 0.0):
+        handler = partial(Handler, recording=recording, latency=latency)
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}/v1"
+
+    def __enter__(self) -> "StubServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    with StubServer(load(args.recording), port=args.port, latency=args.latency) as stub:
+        print(f"serving {args.recording} at {stub.url}")
+        threading.Event().wait()
@@ -1,30 +1,118 @@
 import os
+import time
+import uuid
 import pathlib
+import tempfile
+import asyncio
+import contextlib
+import copy
+import hashlib
 import json
 import logging
-import litellm
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from pydantic import BaseModel
-from typing import List, Callable, Any
-
-class FileContent(BaseModel):
-    filename: str 
-    content: str
+from typing import List, Callable, Any, Tuple, Optional
+from frontogether.snapshot import Snapshot, FileChange
+from frontogether.indexer import MAX_FILE_SIZE, ignored
+from frontogether.argstream import FileStream
+from frontogether.lazy import litellm
+from frontogether.workspace import Workspace, Journal
+from frontogether.transport import Transport, StreamInterrupted
+from frontogether.history import History, Turn
+from frontogether.tracing import Tracer, Trace, log_exporter
+from frontogether.store import SessionStore
+from frontogether.cache import ResponseCache, CachedResponse, cache_key
 
 class Result(BaseModel):
-    messages: List[litellm.Message]
+    messages: List[Any]
     cost: float
+    model: str = ""
+    escalations: int = 0
+    cache_hits: int = 0
+    retries: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+
+    @property
+    def uncached_tokens(self) -> int:
+        return self.input_tokens - self.cached_tokens
+
+CACHE_CONTROL = {"type": "ephemeral"}
+CANCELLED = "[turn cancelled]"
+# string arguments each tool cannot run without
+REQUIRED_ARGS = {
+    "write_file": ("filename", "content"),
+    "read_file": ("filename",),
+    "edit_file": ("filename",),
+}
+
+# a tool call on a path the agent may not touch, returned to the model
+class PathError(RuntimeError):
+    pass
+
+def _atomic_write(output: pathlib.Path, content: str) -> None:
+    mode = output.stat().st_mode & 0o777 if output.exists() else 0o644
+    fd, tmp = tempfile.mkstemp(dir=output.parent, prefix=f".{output.name}.")
+    try:
+        with os.fdopen(fd, "w") as o:
+            o.write(content)
+        os.chmod(tmp, mode)
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 class Agent:
-    def __init__(self):
+    def __init__(self,
+                 model: str = "claude-3-5-sonnet-20240620",
+                 api_base: Optional[str] = None,
+                 history_budget: int = 60000,
+                 keep_turns: int = 4,
+                 prompt_cache: bool = True,
+                 max_steps: int = 25,
+                 context_budget: Optional[int] = 20000,
+                 tracer: Optional[Tracer] = None,
+                 store: Optional[SessionStore] = None,
+                 session: Optional[int] = None,
+                 workspace: Optional[Workspace] = None,
+                 fast_model: Optional[str] = None,
+                 fast_max_chars: int = 300,
+                 cache: Optional[ResponseCache] = None,
+                 transport: Optional[Transport] = None):
         base_dir = pathlib.Path(__file__).parent.resolve()
-        prompt_dir = base_dir.joinpath("prompts")
-        self._env = Environment(
-            loader=FileSystemLoader(prompt_dir),
-            autoescape=select_autoescape(),
-        )
-        self._model = "claude-3-5-sonnet-20240620"
-        self._messages = []
+        self._prompt_dir = base_dir.joinpath("prompts")
+        # built with the first turn, see _load
+        self._env = None
+        self._model = model
+        # short edit requests go to fast_model first
+        self._fast_model = fast_model
+        self._fast_max_chars = fast_max_chars
+        self._cache = cache
+        # shared by the agents of a process for pooled connections
+        self._transport = transport or Transport()
+        self._api_base = api_base
+        self._history = History(budget=history_budget, keep_turns=keep_turns)
+        self._turn = 0
+        self._prompt_cache = prompt_cache
+        self._max_steps = max_steps
+        self._context_budget = context_budget
+        self._tracer = tracer or Tracer([log_exporter])
+        # files are read from and written to the workspace root only
+        self._workspace = workspace or Workspace.cwd()
+        self._root = self._workspace.root
+        self._snapshot = Snapshot(self._root)
+        self._write_listeners = []
+        self._partial_listeners = []
+        # write_file contents streamed to disk, by tool call id
+        self._streams = {}
+        # writes of the current turn, undone when it fails
+        self._journal = Journal()
+        # an existing session is loaded on the first turn, not here
+        self._store = store
+        self._session = session
+        self._resumed = store is None or session is None
+        if store is not None and session is None:
+            self._session = store.create(self._root)
         self._tools = [
             {
                 "type": "function",
@@ -47,148 +135,613 @@ class Agent:
                     } 
                 },
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "read_file",
+                    "description": "Read the content of a workspace file that was only "
+                                   "sent as a summary.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "filename": {
+                                "type": "string",
+                                "description": "",
+                            },
+                        },
+                        "required": ["filename"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "edit_file",
+                    "description": "Apply search/replace edits to an existing file. "
+                                   "Each search text must appear exactly once in the file. "
+                                   "Edits are applied in order and the file is only written "
+                                   "if all of them apply.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "filename": {
+                                "type": "string",
+                                "description": "",
+                            },
+                            "edits": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "search": {
+                                            "type": "string",
+                                            "description": "exact text to be replaced",
+                                        },
+                                        "replace": {
+                                            "type": "string",
+                                            "description": "replacement text",
+                                        },
+                                    },
+                                    "required": ["search", "replace"],
+                                },
+                            },
+                        },
+                        "required": ["filename", "edits"],
+                    },
+                },
+            },
         ]
 
 
-    def _tool_write_file(self, filename: pathlib.Path, content: str) -> str:
-        cwd = pathlib.Path.cwd()
-        output = cwd.joinpath(filename).resolve()
+    @property
+    def workspace(self) -> Workspace:
+        return self._workspace
+
+    @property
+    def session(self) -> Optional[int]:
+        return self._session
+
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        return self._cache
+
+    def _load(self) -> None:
+        # heavy imports are left out of startup and done off the engine
+        # loop before the first request
+        litellm()
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        self._env = Environment(
+            loader=FileSystemLoader(self._prompt_dir),
+            autoescape=select_autoescape(),
+        )
+
+    def _resume(self) -> None:
+        # the latest compaction checkpoint, the turns after it and the
+        # workspace snapshot, so the next turn sends diffs and not a
+        # cold copy of the project
+        summary, turns, entries = self._store.load(self._session)
+        self._history.restore(summary, turns)
+        self._snapshot.restore(entries)
+        self._turn = self._store.last_turn(self._session)
+        self._resumed = True
+        logging.info("resumed session %d at turn %d", self._session, self._turn)
+
+    def _persist(self, turn: Turn) -> None:
+        self._store.append_turn(self._session, turn)
+        self._store.append_snapshot(self._session, turn.index, self._snapshot.entries())
+
+    def add_write_listener(self, callback: Callable[[pathlib.Path], None]) -> None:
+        self._write_listeners.append(callback)
+
+    def add_partial_listener(self, callback: Callable[[pathlib.Path, Optional[pathlib.Path]], None]) -> None:
+        # called with the output and the partial file while it is
+        # generated, and with None when the partial file is discarded
+        self._partial_listeners.append(callback)
+
+    def _partial(self, output: pathlib.Path, temp: Optional[pathlib.Path]) -> None:
+        for callback in self._partial_listeners:
+            callback(output, temp)
+
+    def _written(self, output: pathlib.Path, content: str, edit: bool = False) -> None:
+        self._snapshot.record(self._relative(output), content, self._turn, edit=edit)
+        self._notify(output)
+
+    def _notify(self, output: pathlib.Path) -> None:
+        for callback in self._write_listeners:
+            callback(output)
 
-        if output.parent != cwd:
-            raise RuntimeError(f"only cwd can be written: {cwd}")
+    def _relative(self, output: pathlib.Path) -> str:
+        return output.relative_to(self._root).as_posix()
+
+    def _output_path(self, filename: str) -> pathlib.Path:
+        output = self._root.joinpath(filename).resolve()
+
+        if output == self._root or not output.is_relative_to(self._root) or ignored(self._relative(output)):
+            raise PathError(f"{filename} is outside the workspace or in an ignored path")
+        return output
+
+    def _tool_write_file(self, filename: pathlib.Path, content: str, tool_call_id: Optional[str] = None) -> str:
+        output = self._output_path(filename)
+        stream = self._streams.pop(tool_call_id, None)
 
         logging.info(f"writing file: %s", output)
-        with open(output, "w") as o:
-            o.write(content)
+        self._journal.save(output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        # the content was already streamed to disk while it was generated
+        if stream is None or not stream.commit(output, content):
+            _atomic_write(output, content)
+
+        # the model already has this content in its tool call
+        self._written(output, content)
+        return "true"
 
+    def _tool_read_file(self, filename: str) -> str:
+        output = self._output_path(filename)
+        try:
+            if output.stat().st_size > MAX_FILE_SIZE:
+                # too large for the context, like in the workspace snapshot
+                return f"error: {filename} is larger than {MAX_FILE_SIZE // 1024} KB, use edit_file to change it"
+            content = output.read_text()
+        except (OSError, UnicodeError) as e:
+            return f"error: cannot read {filename}: {e}"
+
+        # later turns only send changes to it
+        self._snapshot.record(self._relative(output), content, self._turn)
+        return content
+
+    def _tool_edit_file(self, filename: str, edits: List[Any]) -> str:
+        output = self._output_path(filename)
+        # arguments come from the model as is
+        if not isinstance(edits, list) or not all(
+                isinstance(edit, dict) and isinstance(edit.get("search", ""), str)
+                and isinstance(edit.get("replace", ""), str) for edit in edits):
+            return "error: edits must be a list of {search, replace} objects"
+
+        # failures are returned to the model, which can fall back to
+        # write_file with the full content
+        try:
+            content = output.read_text()
+        except (OSError, UnicodeError) as e:
+            return f"error: cannot read {filename}: {e}. use write_file instead"
+
+        for i, edit in enumerate(edits):
+            search = edit.get("search", "")
+            count = content.count(search) if search else 0
+            if count != 1:
+                return (f"error: edit {i} search text found {count} times in {filename}, "
+                        "nothing was written. use a unique search text or write_file")
+            content = content.replace(search, edit.get("replace", ""), 1)
+
+        logging.info(f"editing file: %s", output)
+        self._journal.save(output)
+        _atomic_write(output, content)
+
+        self._written(output, content, edit=True)
         return "true"
 
-    def _read_files(self) -> List[FileContent]:
-        res = []
-        dir = pathlib.Path.cwd()
-        for p in os.listdir(dir):
-            path = pathlib.Path(p) 
-            if path.is_file():
-                try:
-                    content = path.read_text()
-                    res.append(FileContent(filename=p, content=content))
-                except UnicodeError:
-                    logging.info(f"skipping file: %s", path)
-        return res
+    def _read_files(self, query: str) -> List[FileChange]:
+        return self._snapshot.update(self._turn, query, self._context_budget)
 
 
-    def _system_prompt(self) -> None:
+    def _system_prompt(self) -> Any:
         temp = self._env.get_template("system.j2")
-        self._messages({
+        return {
             "role": "system",
             "content": temp.render(),
-        })
+        }
+
+    def _cache_layout(self, messages: List[Any]) -> List[Any]:
+        # the history is append-only between compactions, so marking the
+        # system prompt and the last two user messages lets each request
+        # read the prefix written by the previous one. copies are sent,
+        # history messages are left untouched.
+        if not self._prompt_cache:
+            return messages
+
+        marks = [i for i, m in enumerate(messages)
+                 if isinstance(m, dict) and m.get("role") == "user"][-2:]
+        if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+            marks.insert(0, 0)
+
+        res = list(messages)
+        for i in marks:
+            m = copy.copy(messages[i])
+            content = m["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            content = [dict(part) for part in content]
+            content[-1]["cache_control"] = CACHE_CONTROL
+            m["content"] = content
+            res[i] = m
+        return res
 
-    def _do_call(self,
-                 messages: List[Any],
-                 attachment: str = None,
-                 progress_callback: Callable[[str], str] = None,
-                 progress_tool_callback: Callable[[str], str] = None,
-                 finished_callback: Callable[[str], str] = None) -> List[object]:
+    def _cost(self, final: Any) -> float:
+        try:
+            return litellm().completion_cost(final)
+        except Exception:
+            # models without pricing information, e.g. local endpoints
+            logging.info("no cost information for model: %s", self._model)
+            return 0.0
+
+    def _usage(self, chunks: List[Any], final: Any) -> Any:
+        # providers report usage on the last chunks of the stream
+        for chunk in reversed(chunks):
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                return usage
+        return getattr(final, "usage", None)
+
+    async def _stream(self,
+                      trace: Trace,
+                      model: str,
+                      messages: List[Any],
+                      progress_callback: Callable[[str], str] = None,
+                      progress_tool_callback: Callable[[str], str] = None) -> Tuple[Any, List[Any], Any]:
 
         # there is a bug with stream=True and function calling
         # https://github.com/BerriAI/litellm/issues/2716
         # there are some workarounds in chunk processing
-        resp = litellm.completion(
-            model=self._model,
-            messages=messages,
-            tools=self._tools,
-            stream=True,
-        )
+        with self._tracer.span(trace, "request"):
+            resp = await self._transport.acompletion(
+                model=model,
+                messages=self._cache_layout(messages),
+                tools=self._tools,
+                stream=True,
+                stream_options={"include_usage": True},
+                **({"api_base": self._api_base} if self._api_base else {}),
+            )
 
+        # checked once, chunks are only logged when debugging
+        debug = logging.root.isEnabledFor(logging.DEBUG)
         tool_calls = []
+        # argument deltas are joined once at the end
+        arguments = []
+        streams = []
         chunks = []
-        for chunk in resp:
-            logging.info(chunk)
-            delta = chunk.choices[0].delta
-
-            if delta.content and delta.content != "":
-                if progress_callback:
-                    progress_callback(delta.content)
-
-            raw_tool_calls = delta.get("tool_calls", [])
-            if raw_tool_calls:
-                for tool_call in delta.tool_calls:
-                    logging.info("tool_call %s", str(tool_call))
-                    if tool_call.id:
-                        tool_calls.append(tool_call)
-                        if progress_tool_callback:
-                            progress_tool_callback(f"\nfunc({tool_call.function.name})")
-                    elif tool_call.function.arguments:
-                        tool_calls[-1].function.arguments += tool_call.function.arguments
-                        if progress_tool_callback:
-                            progress_tool_callback(f".")
-
-            chunks.append(chunk)
-
-        final = litellm.stream_chunk_builder(chunks)
+        with self._tracer.span(trace, "stream") as span:
+            try:
+                async for chunk in resp:
+                    if not chunks:
+                        self._tracer.first_token(trace)
+                    if debug:
+                        logging.debug("chunk %s", chunk)
+                    chunks.append(chunk)
+                    if not chunk.choices:
+                        # usage only chunk
+                        continue
+                    delta = chunk.choices[0].delta
+
+                    if delta.content and delta.content != "":
+                        if progress_callback:
+                            progress_callback(delta.content)
+
+                    raw_tool_calls = delta.get("tool_calls", [])
+                    if raw_tool_calls:
+                        for tool_call in delta.tool_calls:
+                            if debug:
+                                logging.debug("tool_call %s", tool_call)
+                            if tool_call.id:
+                                tool_calls.append(tool_call)
+                                arguments.append([])
+                                streams.append(self._file_stream(tool_call))
+                                if progress_tool_callback:
+                                    progress_tool_callback(f"\nfunc({tool_call.function.name})")
+                            if tool_call.function.arguments:
+                                arguments[-1].append(tool_call.function.arguments)
+                                if streams[-1]:
+                                    streams[-1].feed(tool_call.function.arguments)
+                                if not tool_call.id and progress_tool_callback:
+                                    progress_tool_callback(f".")
+                # litellm ends a dropped stream with a made up finish
+                # reason, the one received from the provider is kept apart
+                if getattr(resp, "received_finish_reason", "") is None:
+                    raise StreamInterrupted(f"stream ended after {len(chunks)} chunks")
+            except BaseException:
+                # partial files of an interrupted stream are never used
+                for stream in streams:
+                    if stream:
+                        stream.discard()
+                # drop the connection so the provider stops generating, a
+                # broken one is not reused
+                close = getattr(getattr(resp, "completion_stream", None), "aclose", None)
+                if close:
+                    with contextlib.suppress(Exception):
+                        await close()
+                raise
+            span.attrs["chunks"] = len(chunks)
+
+        for tool_call, parts, stream in zip(tool_calls, arguments, streams):
+            tool_call.function.arguments = "".join(parts)
+            if stream:
+                self._streams[tool_call.id] = stream
+
+        with self._tracer.span(trace, "chunk_builder"):
+            final = litellm().stream_chunk_builder(chunks)
         # append tool_calls because of bug
         final.choices[0].message.tool_calls = tool_calls
-        logging.info(final)
-        if finished_callback:
-            finished_callback(final.choices[0].message)
-
-        new_messages = []
-        new_messages.append(final.choices[0].message)
+        if debug:
+            logging.debug("final %s", final)
+        return final, tool_calls, self._usage(chunks, final)
+
+    def _file_stream(self, tool_call: Any) -> Optional[FileStream]:
+        if tool_call.function.name != "write_file":
+            return None
+        return FileStream(self._root, self._output_path, self._partial)
+
+    async def _complete(self,
+                        trace: Trace,
+                        ret: Result,
+                        model: str,
+                        messages: List[Any],
+                        workspace: str,
+                        progress_callback: Callable[[str], str] = None,
+                        progress_tool_callback: Callable[[str], str] = None) -> Tuple[Any, List[Any], Any, float, bool]:
+        key = None
+        if self._cache is not None:
+            key = cache_key(model, messages, self._tools, workspace)
+            with self._tracer.span(trace, "cache"):
+                cached = await asyncio.to_thread(self._cache.get, key)
+            if cached:
+                message, tool_calls = self._replay(cached, progress_callback, progress_tool_callback)
+                return message, tool_calls, None, 0.0, True
+
+        def on_retry(attempt: int, delay: float, e: BaseException) -> None:
+            # the output streamed so far is dropped and generated again
+            ret.retries += 1
+            trace.retries += 1
+            if progress_callback:
+                progress_callback(f"\n[{type(e).__name__}, retrying in {delay:.1f}s]\n")
+
+        start = time.perf_counter()
+        final, tool_calls, usage = await self._transport.retry(
+            lambda: self._stream(
+                trace,
+                model,
+                messages,
+                progress_callback=progress_callback,
+                progress_tool_callback=progress_tool_callback,
+            ),
+            on_retry=on_retry,
+        )
+        cost = self._cost(final)
+        message = final.choices[0].message
+        if key:
+            await asyncio.to_thread(self._cache.put, key, model, message, time.perf_counter() - start, cost)
+        return message, tool_calls, usage, cost, False
+
+    def _replay(self, cached: CachedResponse,
+                progress_callback: Callable[[str], str] = None,
+                progress_tool_callback: Callable[[str], str] = None) -> Tuple[Any, List[Any]]:
+        # the tools of a cached response still run, with fresh call ids
+        tool_calls = [dict(t, id=f"call_{uuid.uuid4().hex[:24]}")
+                      for t in cached.message.get("tool_calls") or []]
+        message = litellm().Message(content=cached.message.get("content"), tool_calls=tool_calls)
+        if message.content and progress_callback:
+            progress_callback(message.content)
+        for tool_call in message.tool_calls or []:
+            if progress_tool_callback:
+                progress_tool_callback(f"\nfunc({tool_call.function.name})")
+        return message, message.tool_calls or []
+
+    def _pick_model(self, content: str, attachment: Optional[str]) -> str:
+        # short instructions on an existing page without a screenshot are
+        # usually small edits
+        if (self._fast_model and not attachment and len(content) <= self._fast_max_chars
+                and self._snapshot.entries()):
+            return self._fast_model
+        return self._model
+
+    def _failed(self, tool_messages: List[Any]) -> bool:
+        return any(m["content"].startswith("error:") for m in tool_messages)
+
+    def _run_tool(self, tool_call: Any, function_args: Any) -> Any:
+        function_name = tool_call.function.name
+        try:
+            function_response = self._call_tool(tool_call, function_args)
+        except PathError as e:
+            # the rest of the turn is kept, the model can pick another path
+            function_response = f"error: {e}"
+
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "name": function_name,
+            "content": function_response,
+        }
+
+    def _call_tool(self, tool_call: Any, function_args: Any) -> str:
+        function_name = tool_call.function.name
+        if not isinstance(function_args, dict):
+            return "error: arguments are not a valid json object"
+        for name in REQUIRED_ARGS.get(function_name, ()):
+            if not isinstance(function_args.get(name), str):
+                return f"error: {function_name} needs a string argument {name}"
+        if function_name == "write_file":
+            return self._tool_write_file(
+                function_args.get("filename"),
+                function_args.get("content"),
+                tool_call.id,
+            )
+        if function_name == "read_file":
+            return self._tool_read_file(
+                function_args.get("filename"),
+            )
+        if function_name == "edit_file":
+            return self._tool_edit_file(
+                function_args.get("filename"),
+                function_args.get("edits", []),
+            )
+        raise RuntimeError(f"invalid tool: {function_name}")
 
+    async def _run_tools(self, tool_calls: List[Any]) -> List[Any]:
+        # calls touching different files are independent and run
+        # concurrently, calls on the same file keep their order
+        groups = {}
         for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            logging.info(tool_call.function.arguments)
-            function_args = json.loads(tool_call.function.arguments)
-
-            if function_name == "write_file":
-                function_response = self._tool_write_file(
-                    function_args.get("filename"),
-                    function_args.get("content"),
-                )
-            else:
-                raise RuntimeError(f"invalid tool: {function_name}")
-
-            tool_msg = {
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "name": function_name,
-                "content": function_response,
-            }
-
-            new_messages.append(tool_msg)
-
-        ret = Result(
-            messages=new_messages,
-            cost=litellm.completion_cost(final),
-        )
-            
-        if len(tool_calls) > 0:
-            # functions were called, get new message
-            res = self._do_call(
-                messages=messages + new_messages,
-                attachment=attachment,
+            try:
+                function_args = json.loads(tool_call.function.arguments)
+            except ValueError:
+                function_args = None
+            filename = function_args.get("filename") if isinstance(function_args, dict) else None
+            groups.setdefault(filename, []).append((tool_call, function_args))
+
+        async def run_group(group):
+            return [await asyncio.to_thread(self._run_tool, tool_call, function_args)
+                    for tool_call, function_args in group]
+
+        responses = {}
+        try:
+            for group in await asyncio.gather(*(run_group(g) for g in groups.values())):
+                for tool_msg in group:
+                    responses[tool_msg["tool_call_id"]] = tool_msg
+        finally:
+            # streamed files of calls that failed before writing
+            for tool_call in tool_calls:
+                stream = self._streams.pop(tool_call.id, None)
+                if stream:
+                    stream.discard()
+        return [responses[tool_call.id] for tool_call in tool_calls]
+
+    async def _do_call(self,
+                       trace: Trace,
+                       ret: Result,
+                       model: str,
+                       workspace: str,
+                       messages: List[Any],
+                       progress_callback: Callable[[str], str] = None,
+                       progress_tool_callback: Callable[[str], str] = None,
+                       finished_callback: Callable[[str], str] = None) -> Result:
+
+        # only complete steps, an assistant message with the results of
+        # all its tool calls, are added to ret
+        messages = list(messages)
+        for step in range(self._max_steps):
+            trace.rounds = step + 1
+            ret.model = model
+            message, tool_calls, usage, cost, hit = await self._complete(
+                trace,
+                ret,
+                model,
+                messages,
+                workspace,
                 progress_callback=progress_callback,
                 progress_tool_callback=progress_tool_callback,
-                finished_callback=finished_callback,
             )
+            if finished_callback:
+                finished_callback(message)
 
-            ret.messages += res.messages
-            ret.cost += res.cost
+            new_messages = [message]
+            with self._tracer.span(trace, "tools", calls=len(tool_calls)):
+                tools = asyncio.ensure_future(self._run_tools(tool_calls))
+                try:
+                    new_messages += await asyncio.shield(tools)
+                except asyncio.CancelledError:
+                    # writes run in threads and cannot be interrupted,
+                    # wait for them so the history matches the workspace
+                    ret.messages += new_messages + await tools
+                    raise
+            messages += new_messages
+
+            ret.messages += new_messages
+            ret.cost += cost
+            ret.cache_hits += hit
+            if usage:
+                details = getattr(usage, "prompt_tokens_details", None)
+                ret.input_tokens += getattr(usage, "prompt_tokens", 0) or 0
+                ret.cached_tokens += (getattr(usage, "cache_read_input_tokens", 0)
+                                      or getattr(details, "cached_tokens", 0) or 0)
+                ret.cache_write_tokens += getattr(usage, "cache_creation_input_tokens", 0) or 0
+                trace.output_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+            if len(tool_calls) == 0:
+                break
+            if model != self._model and self._failed(new_messages[1:]):
+                # the errors stay in the history for the stronger model
+                logging.info("escalating from %s to %s", model, self._model)
+                model = self._model
+                ret.escalations += 1
+        else:
+            logging.warning("tool loop stopped after %d steps", self._max_steps)
 
+        trace.model = ret.model
+        trace.input_tokens = ret.input_tokens
+        trace.cached_tokens = ret.cached_tokens
+        trace.cost = ret.cost
         return ret
 
     def answer(self, content: str,
                attachment:str = None,
                progress_callback: Callable[[str], str] = None,
                progress_tool_callback: Callable[[str], str] = None,
-               finished_callback: Callable[[str], str] = None) -> List[object]:
-        files = self._read_files()
-        temp = self._env.get_template("message.j2")
-        prompt = temp.render(files=files, content=content)
+               finished_callback: Callable[[str], str] = None) -> Result:
+        return asyncio.run(self.aanswer(
+            content,
+            attachment=attachment,
+            progress_callback=progress_callback,
+            progress_tool_callback=progress_tool_callback,
+            finished_callback=finished_callback,
+        ))
+
+    async def aanswer(self, content: str,
+               attachment:str = None,
+               progress_callback: Callable[[str], str] = None,
+               progress_tool_callback: Callable[[str], str] = None,
+               finished_callback: Callable[[str], str] = None) -> Result:
+        if self._env is None:
+            await asyncio.to_thread(self._load)
+        if not self._resumed:
+            await asyncio.to_thread(self._resume)
+
+        compactions = self._history.stats.compactions
+        dropped = self._history.compact()
+        if dropped:
+            # file contents the snapshot refers to are gone
+            self._snapshot.forget(dropped)
+        if self._store is not None and self._history.stats.compactions != compactions:
+            summary, turns = self._history.state()
+            await asyncio.to_thread(self._store.append_checkpoint, self._session, self._turn, summary, turns)
+
+        self._turn += 1
+        trace = self._tracer.begin(self._turn, self._model)
+        try:
+            ret = await self._answer(trace, content, attachment,
+                                     progress_callback=progress_callback,
+                                     progress_tool_callback=progress_tool_callback,
+                                     finished_callback=finished_callback)
+        except BaseException as e:
+            self._tracer.end(trace, e)
+            raise
+        self._tracer.end(trace)
+        return ret
 
+    async def _answer(self, trace: Trace, content: str,
+                      attachment: str = None,
+                      progress_callback: Callable[[str], str] = None,
+                      progress_tool_callback: Callable[[str], str] = None,
+                      finished_callback: Callable[[str], str] = None) -> Result:
+        # reading the files marks them as sent, which a failed turn undoes
+        entries = self._snapshot.entries()
+        with self._tracer.span(trace, "read_files"):
+            files = self._read_files(content)
+        with self._tracer.span(trace, "render"):
+            temp = self._env.get_template("message.j2")
+            prompt = temp.render(files=files, content=content)
+            brief = temp.render(files=[], content=content)
+
+        image = None
         if attachment:
-            self._messages.append({
+            # plain base64 is a png, as sent by older callers
+            if not attachment.startswith("data:"):
+                attachment = f"data:image/png;base64,{attachment}"
+            image = hashlib.sha256(attachment.encode()).hexdigest()
+            seen = self._history.image_turn(image)
+            if seen is not None:
+                prompt += f"\nscreenshot unchanged since turn {seen}\n"
+                attachment = None
+                image = None
+
+        if attachment:
+            message = {
                 "role": "user",
                 "content": [
                     {
@@ -198,28 +751,57 @@ class Agent:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/png;base64,{str(attachment)}",
+                            "url": attachment,
                         },
                     },
                 ],
-            })
-            #import sys; sys.exit(1)
+            }
         else:
-            self._messages.append({
+            message = {
                 "role": "user",
                 "content": prompt,
-            })
-
-        ret = self._do_call(
-            messages=self._messages,
-            progress_callback=progress_callback,
-            progress_tool_callback=progress_tool_callback,
-            finished_callback=finished_callback,
-        )
+            }
 
-        self._messages += ret.messages
+        ret = Result(messages=[], cost=0.0)
+        self._journal = Journal()
+        try:
+            await self._do_call(
+                trace,
+                ret,
+                self._pick_model(content, attachment),
+                self._snapshot.digest(),
+                messages=[self._system_prompt()] + self._history.messages() + [message],
+                progress_callback=progress_callback,
+                progress_tool_callback=progress_tool_callback,
+                finished_callback=finished_callback,
+            )
+        except asyncio.CancelledError:
+            # completed steps are kept, the model sees what was done
+            # before the cancellation on the next turn
+            ret.messages.append({"role": "assistant", "content": CANCELLED})
+            await self._record(Turn(index=self._turn, content=content, brief=brief, image=image,
+                                    messages=[message] + ret.messages))
+            raise
+        except Exception:
+            # a failed turn is not added to the history, its writes are
+            # undone so the next turn starts from what the model knows
+            restored = await asyncio.to_thread(self._journal.rollback)
+            self._snapshot.restore(entries)
+            if restored:
+                logging.warning("turn %d failed, restored %d files", self._turn, len(restored))
+            for output in restored:
+                self._notify(output)
+            raise
+
+        await self._record(Turn(index=self._turn, content=content, brief=brief, image=image,
+                                messages=[message] + ret.messages))
         return ret
 
+    async def _record(self, turn: Turn) -> None:
+        self._history.append(turn)
+        if self._store is not None:
+            await asyncio.to_thread(self._persist, turn)
+
 
 if __name__ == "__main__":
     def progress_callback(msg):
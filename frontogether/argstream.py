@@ -0,0 +1,254 @@
+import os
+import time
+import hashlib
+import logging
+import pathlib
+import tempfile
+from typing import Callable, List, Optional
+from frontogether.workspace import STATE_DIR
+
+# partial files are written next to the workspace so the final rename
+# stays on the same filesystem
+PARTIAL_DIR = pathlib.Path(STATE_DIR, "partial")
+# how often a growing file is announced to the preview
+PARTIAL_INTERVAL = 0.3
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# incremental parser for the top level string values of a json object,
+# e.g. the arguments of write_file. decoded pieces of each value are
+# reported as they arrive, other values are skipped.
+class ArgumentParser:
+    def __init__(self, on_value: Callable[[str, str, bool], None]):
+        self._on_value = on_value
+        self._state = "start"
+        self._key = None
+        self._key_parts: List[str] = []
+        self._escape = ""
+        self._high = None
+        self._depth = 0
+        self._skip_string = False
+        self._skip_escape = False
+
+    def feed(self, text: str) -> None:
+        i = 0
+        n = len(text)
+        while i < n:
+            state = self._state
+            if state in ("key", "value"):
+                i = self._string(text, i)
+                continue
+            if state == "skip":
+                i = self._skip(text, i)
+                continue
+            c = text[i]
+            i += 1
+            if c.isspace():
+                continue
+            if state == "start":
+                self._state = "object" if c == "{" else "invalid"
+            elif state == "object":
+                if c == '"':
+                    self._state = "key"
+                    self._key_parts = []
+                elif c == "}":
+                    self._state = "end"
+            elif state == "colon":
+                if c == ":":
+                    self._state = "before_value"
+            elif state == "before_value":
+                if c == '"':
+                    self._state = "value"
+                else:
+                    self._state = "skip"
+                    self._depth = 0
+                    i -= 1
+            elif state == "after_value":
+                if c == ",":
+                    self._state = "object"
+                elif c == "}":
+                    self._state = "end"
+            else:
+                # after the object or invalid input
+                return
+
+    def _string(self, text: str, i: int) -> int:
+        n = len(text)
+        pieces = []
+        done = False
+        while i < n:
+            if self._escape:
+                self._escape += text[i]
+                i += 1
+                decoded = self._unescape()
+                if decoded is not None:
+                    pieces.append(decoded)
+                continue
+            quote = text.find('"', i)
+            backslash = text.find("\\", i)
+            end = quote if backslash < 0 or 0 <= quote < backslash else backslash
+            if end < 0:
+                pieces.append(text[i:])
+                i = n
+                break
+            pieces.append(text[i:end])
+            i = end + 1
+            if text[end] == '"':
+                done = True
+                break
+            self._escape = "\\"
+
+        piece = "".join(pieces)
+        if self._state == "key":
+            self._key_parts.append(piece)
+            if done:
+                self._key = "".join(self._key_parts)
+                self._state = "colon"
+        else:
+            if piece or done:
+                self._on_value(self._key, piece, done)
+            if done:
+                self._state = "after_value"
+        return i
+
+    def _unescape(self) -> Optional[str]:
+        # None while the escape sequence is incomplete
+        kind = self._escape[1]
+        if kind != "u":
+            self._escape = ""
+            return ESCAPES.get(kind, kind)
+        if len(self._escape) < 6:
+            return None
+        code = int(self._escape[2:], 16)
+        self._escape = ""
+        if 0xD800 <= code < 0xDC00:
+            self._high = code
+            return ""
+        if 0xDC00 <= code < 0xE000 and self._high is not None:
+            code = 0x10000 + ((self._high - 0xD800) << 10) + (code - 0xDC00)
+        self._high = None
+        return chr(code)
+
+    def _skip(self, text: str, i: int) -> int:
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if self._skip_string:
+                if self._skip_escape:
+                    self._skip_escape = False
+                elif c == "\\":
+                    self._skip_escape = True
+                elif c == '"':
+                    self._skip_string = False
+            elif c == '"':
+                self._skip_string = True
+            elif c in "[{":
+                self._depth += 1
+            elif c in "]}" or c == ",":
+                if self._depth == 0:
+                    # end of a plain value, the separator is read again
+                    self._state = "after_value"
+                    return i
+                if c != ",":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._state = "after_value"
+                        return i + 1
+            i += 1
+        return i
+
+# streams the content of a write_file call into a temporary file while
+# the arguments are generated. the file is renamed over the output once
+# the tool runs, if it matches the final arguments.
+class FileStream:
+    def __init__(self,
+                 root: pathlib.Path,
+                 resolve: Callable[[str], pathlib.Path],
+                 listener: Optional[Callable[[pathlib.Path, Optional[pathlib.Path]], None]] = None):
+        self._root = root
+        self._resolve = resolve
+        self._listener = listener
+        self._parser = ArgumentParser(self._value)
+        self._filename: List[str] = []
+        self._pending: List[str] = []
+        self._hash = hashlib.sha256()
+        self._file = None
+        self._output = None
+        self._temp = None
+        self._done = False
+        self._failed = False
+        self._last = 0.0
+
+    def feed(self, text: str) -> None:
+        if self._failed:
+            return
+        try:
+            self._parser.feed(text)
+        except (OSError, RuntimeError, ValueError) as e:
+            # the tool call is executed from the final arguments anyway
+            logging.info("not streaming tool arguments: %s", e)
+            self._failed = True
+            self.discard()
+
+    def _value(self, key: str, piece: str, done: bool) -> None:
+        if key == "filename":
+            self._filename.append(piece)
+            if done:
+                self._open("".join(self._filename))
+        elif key == "content":
+            self._hash.update(piece.encode("utf-8", "surrogatepass"))
+            if self._file:
+                self._file.write(piece)
+            else:
+                self._pending.append(piece)
+            if done:
+                self._done = True
+                if self._file:
+                    self._file.close()
+                    self._notify()
+            elif self._file and time.monotonic() - self._last >= PARTIAL_INTERVAL:
+                self._file.flush()
+                self._notify()
+
+    def _open(self, filename: str) -> None:
+        self._output = self._resolve(filename)
+        directory = self._root.joinpath(PARTIAL_DIR, self._output.relative_to(self._root)).parent
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{self._output.name}.")
+        self._temp = pathlib.Path(tmp)
+        self._file = os.fdopen(fd, "w")
+        self._file.write("".join(self._pending))
+        self._pending = []
+        if self._done:
+            self._file.close()
+            self._notify()
+
+    def _notify(self) -> None:
+        self._last = time.monotonic()
+        if self._listener:
+            self._listener(self._output, self._temp)
+
+    def commit(self, output: pathlib.Path, content: str) -> bool:
+        # false when the streamed file cannot be used, it is discarded
+        if (self._failed or not self._done or self._temp is None or output != self._output
+                or self._hash.hexdigest() != hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()):
+            self.discard()
+            return False
+        mode = output.stat().st_mode & 0o777 if output.exists() else 0o644
+        os.chmod(self._temp, mode)
+        os.replace(self._temp, output)
+        self._temp = None
+        return True
+
+    def discard(self) -> None:
+        if self._file and not self._file.closed:
+            self._file.close()
+        if self._temp:
+            try:
+                os.unlink(self._temp)
+            except OSError:
+                pass
+            self._temp = None
+            # no temp file, the listener stops showing the partial one
+            if self._listener and self._last:
+                self._listener(self._output, None)
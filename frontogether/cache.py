@@ -0,0 +1,114 @@
+import json
+import time
+import sqlite3
+import hashlib
+import pathlib
+import threading
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+from frontogether.history import plain
+
+SCHEMA = """
+create table if not exists responses (
+    key text primary key,
+    model text not null,
+    message text not null,
+    size integer not null,
+    latency real not null,
+    cost real not null,
+    created real not null,
+    used real not null
+);
+create index if not exists responses_used on responses(used);
+"""
+
+class CachedResponse(BaseModel):
+    model: str
+    message: Dict[str, Any]
+    latency: float
+    cost: float
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    latency_saved: float = 0.0
+    cost_saved: float = 0.0
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (f"cache hits {self.hits}/{total} ({rate:.0f}%), "
+                f"saved {self.latency_saved:.1f}s and {self.cost_saved:.4f}")
+
+def _normalize(message: Any) -> Dict[str, Any]:
+    # tool call ids are generated per request and replayed hits get new
+    # ones, they do not change what the model is asked
+    m = dict(plain(message))
+    m.pop("tool_call_id", None)
+    if m.get("tool_calls"):
+        m["tool_calls"] = [{"function": t["function"]} for t in m["tool_calls"]]
+    return m
+
+def cache_key(model: str, messages: List[Any], tools: List[Any], workspace: str) -> str:
+    data = json.dumps({
+        "model": model,
+        "messages": [_normalize(m) for m in messages],
+        "tools": tools,
+        "workspace": workspace,
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8", "surrogatepass")).hexdigest()
+
+# completed model responses on disk, one per request of the tool loop.
+# entries are evicted least recently used first once the cache grows
+# over max_bytes.
+class ResponseCache:
+    def __init__(self, path: pathlib.Path, max_bytes: int = 64 * 1024 * 1024):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.executescript(SCHEMA)
+        self.stats = CacheStats()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock, self._db:
+            row = self._db.execute(
+                "select model, message, latency, cost from responses where key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._db.execute("update responses set used = ? where key = ?", (time.time(), key))
+        self.stats.hits += 1
+        self.stats.latency_saved += row[2]
+        self.stats.cost_saved += row[3]
+        return CachedResponse(model=row[0], message=json.loads(row[1]), latency=row[2], cost=row[3])
+
+    def put(self, key: str, model: str, message: Any, latency: float, cost: float) -> None:
+        data = json.dumps(plain(message))
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "insert or replace into responses (key, model, message, size, latency, cost, created, used) "
+                "values (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, data, len(data), latency, cost, now, now),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._db.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        rows = self._db.execute("select key, size from responses order by used").fetchall()
+        drop = []
+        for key, size in rows:
+            if total <= self._max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        self._db.executemany("delete from responses where key = ?", drop)
@@ -1,57 +1,149 @@
 from PySide6.QtWidgets import QWidget
-from PySide6.QtGui import QPainter, QPen, QColor, QPainterPath, QPixmap
-from PySide6.QtCore import Qt
+from PySide6.QtGui import QPainter, QPen, QPixmap, QPolygonF
+from PySide6.QtCore import Qt, QRect, QRectF
+
+# points closer than this to the previous one are not stored
+MIN_DISTANCE = 1.5
+# tolerance used to simplify finished strokes
+SIMPLIFY_EPSILON = 0.75
+
+def _distance(p, a, b):
+    dx, dy = b.x() - a.x(), b.y() - a.y()
+    norm = (dx * dx + dy * dy) ** 0.5
+    if norm == 0:
+        return ((p.x() - a.x()) ** 2 + (p.y() - a.y()) ** 2) ** 0.5
+    return abs(dy * p.x() - dx * p.y() + b.x() * a.y() - b.y() * a.x()) / norm
+
+def _simplify(points, epsilon):
+    # ramer-douglas-peucker, iterative so long strokes do not recurse deep
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        index, dmax = 0, 0.0
+        for i in range(start + 1, end):
+            d = _distance(points[i], points[start], points[end])
+            if d > dmax:
+                index, dmax = i, d
+        if dmax > epsilon:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return [p for p, k in zip(points, keep) if k]
 
 class Canvas(QWidget):
     def __init__(self):
         super().__init__()
         self.setMinimumSize(200, 200)
-        self._paths = []
-        self._current_path = None
+        self._strokes = []
+        self._current = None
         self._pen_color = Qt.black
         self._pen_width = 2
         self._bg = QPixmap()
+        # background and finished strokes, rebuilt only when invalidated
+        self._backing = None
 
     def set_bg(self, bg):
         self._bg = bg
+        self._backing = None
 
     def clear(self):
-        self._paths = []
+        self._strokes = []
         self._bg = QPixmap()
+        self._backing = None
 
     def grab(self):
         pxmap = QPixmap(self.width(), self.height())
-        self._paint(pxmap)
-        pxmap.save("debug.png")
+        pxmap.fill(Qt.white)
+        painter = QPainter(pxmap)
+        painter.drawPixmap(0, 0, self._backing_store())
+        if self._current:
+            painter.setRenderHint(QPainter.Antialiasing)
+            self._draw_stroke(painter, self._current)
+        painter.end()
         return pxmap
 
+    def resizeEvent(self, event):
+        self._backing = None
+        super().resizeEvent(event)
+
     def paintEvent(self, event):
-        self._paint(self)
+        # the painter is clipped to the dirty region
+        painter = QPainter(self)
+        painter.drawPixmap(0, 0, self._backing_store())
+        if self._current:
+            painter.setRenderHint(QPainter.Antialiasing)
+            self._draw_stroke(painter, self._current)
+
+    def _backing_store(self):
+        if self._backing is None:
+            ratio = self.devicePixelRatioF()
+            self._backing = QPixmap(self.size() * ratio)
+            self._backing.setDevicePixelRatio(ratio)
+            self._backing.fill(Qt.transparent)
+            painter = QPainter(self._backing)
+            painter.drawPixmap(0, 0, self._bg)
+            painter.setRenderHint(QPainter.Antialiasing)
+            for stroke in self._strokes:
+                self._draw_stroke(painter, stroke)
+            painter.end()
+        return self._backing
+
+    def _draw_stroke(self, painter, stroke):
+        painter.setPen(stroke['pen'])
+        if stroke['points'].size() == 1:
+            painter.drawPoint(stroke['points'].first())
+        else:
+            painter.drawPolyline(stroke['points'])
 
-    def _paint(self, canv):
-        painter = QPainter(canv)
-        painter.setRenderHint(QPainter.Antialiasing)
-        painter.drawPixmap(0, 0, self._bg)
-        for path in self._paths:
-            pen = QPen(path['color'], path['width'], Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            painter.setPen(pen)
-            painter.drawPath(path['path'])
+    def _dirty(self, rect: QRectF, width: int):
+        margin = width + 2
+        self.update(rect.normalized().adjusted(-margin, -margin, margin, margin).toAlignedRect())
 
+    def annotation_rect(self) -> QRect:
+        rect = QRectF()
+        for stroke in self._strokes:
+            rect = rect.united(stroke['points'].boundingRect())
+        return rect.toAlignedRect()
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
-            self._current_path = {'path': QPainterPath(), 'color': self._pen_color, 'width': self._pen_width}
-            self._current_path['path'].moveTo(event.pos())
-            self._paths.append(self._current_path)
+            pen = QPen(self._pen_color, self._pen_width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+            self._current = {
+                'points': QPolygonF([event.position()]),
+                'pen': pen,
+                'width': self._pen_width,
+            }
+            self._dirty(QRectF(event.position(), event.position()), self._pen_width)
 
     def mouseMoveEvent(self, event):
-        if event.buttons() & Qt.LeftButton and self._current_path:
-            self._current_path['path'].lineTo(event.pos())
-            self.update()
+        if event.buttons() & Qt.LeftButton and self._current:
+            points = self._current['points']
+            last = points.last()
+            pos = event.position()
+            delta = pos - last
+            if abs(delta.x()) + abs(delta.y()) < MIN_DISTANCE:
+                return
+            points.append(pos)
+            self._dirty(QRectF(last, pos), self._current['width'])
 
     def mouseReleaseEvent(self, event):
-        if event.button() == Qt.LeftButton and self._current_path:
-            self._current_path['path'].lineTo(event.pos())
-            self._current_path = None
-            self.update()
+        if event.button() == Qt.LeftButton and self._current:
+            stroke = self._current
+            self._current = None
+            points = list(stroke['points'])
+            if points[-1] != event.position():
+                points.append(event.position())
+            stroke['points'] = QPolygonF(_simplify(points, SIMPLIFY_EPSILON))
+            self._strokes.append(stroke)
 
+            # bake the finished stroke instead of rebuilding the store
+            if self._backing is not None:
+                painter = QPainter(self._backing)
+                painter.setRenderHint(QPainter.Antialiasing)
+                self._draw_stroke(painter, stroke)
+                painter.end()
+            self._dirty(stroke['points'].boundingRect(), stroke['width'])
@@ -0,0 +1,29 @@
+from PySide6.QtWidgets import QTextEdit
+from PySide6.QtGui import QTextCursor
+
+class ChatView(QTextEdit):
+    def __init__(self, max_blocks: int = 5000):
+        super().__init__()
+        self.setReadOnly(True)
+        # appends would otherwise be kept forever in the undo stack
+        self.setUndoRedoEnabled(False)
+        # oldest blocks are dropped once the limit is reached
+        self.document().setMaximumBlockCount(max_blocks)
+
+    def append_html(self, msg: str) -> None:
+        self._append(lambda cursor: cursor.insertHtml(msg))
+
+    def append_text(self, msg: str) -> None:
+        self._append(lambda cursor: cursor.insertText(msg))
+
+    def _append(self, insert) -> None:
+        # only follow the output when the user has not scrolled up
+        sbar = self.verticalScrollBar()
+        follow = sbar.value() >= sbar.maximum() - 4
+
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        insert(cursor)
+
+        if follow:
+            sbar.setValue(sbar.maximum())
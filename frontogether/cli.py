@@ -0,0 +1,180 @@
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import pathlib
+import argparse
+from pydantic import BaseModel, Field
+from typing import Any, List, Optional
+from frontogether.agent import Agent
+from frontogether.cache import ResponseCache
+from frontogether.indexer import walk
+from frontogether.tracing import Tracer, JsonLinesExporter, log_exporter
+from frontogether.workspace import Workspace
+from frontogether.transport import Transport
+
+PROMPT_SUFFIXES = (".txt", ".md")
+RESULTS_FILE = "results.jsonl"
+
+class Job(BaseModel):
+    id: str
+    brief: str
+    attachment: Optional[str] = None
+
+class JobResult(BaseModel):
+    id: str
+    directory: str
+    ok: bool = False
+    retries: int = 0
+    cost: float = 0.0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    duration: float = 0.0
+    files: List[str] = Field(default_factory=list)
+    error: Optional[str] = None
+
+def _job_id(value: Any) -> str:
+    # ids name the job directories under --output, they cannot leave it
+    # or be hidden
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip(".") or "job"
+
+def _unique_ids(jobs: List[Job]) -> List[Job]:
+    # the first job keeps a repeated id, the others get a suffix
+    seen = {RESULTS_FILE}
+    for job in jobs:
+        name = _job_id(job.id)
+        i = 2
+        while name in seen:
+            name = f"{_job_id(job.id)}-{i}"
+            i += 1
+        if name != job.id:
+            logging.warning("job %r runs as %s", job.id, name)
+            job.id = name
+        seen.add(name)
+    return jobs
+
+def load_jobs(path: pathlib.Path) -> List[Job]:
+    # a json lines file with id, brief and an optional attachment per
+    # line, or a directory with one prompt file per job
+    if path.is_dir():
+        return _unique_ids([Job(id=p.stem, brief=p.read_text())
+                            for p in sorted(path.iterdir()) if p.suffix in PROMPT_SUFFIXES])
+    jobs = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            data["id"] = str(data.get("id", f"job{i + 1}"))
+            jobs.append(Job(**data))
+    return _unique_ids(jobs)
+
+class Runner:
+    def __init__(self,
+                 output: pathlib.Path,
+                 model: str,
+                 api_base: Optional[str] = None,
+                 concurrency: int = 4,
+                 tracer: Optional[Tracer] = None,
+                 fast_model: Optional[str] = None,
+                 cache: Optional[ResponseCache] = None,
+                 transport: Optional[Transport] = None):
+        self._output = output
+        self._model = model
+        self._api_base = api_base
+        self._concurrency = concurrency
+        self._tracer = tracer
+        self._fast_model = fast_model
+        self._cache = cache
+        # one connection pool and retry budget for all jobs, failed
+        # requests are only retried there
+        self._transport = transport or Transport()
+
+    async def run(self, jobs: List[Job]) -> List[JobResult]:
+        semaphore = asyncio.Semaphore(self._concurrency)
+        lock = asyncio.Lock()
+        results = self._output.joinpath(RESULTS_FILE)
+        # results of an earlier run in the same directory are replaced
+        results.write_text("")
+
+        async def run_one(job: Job) -> JobResult:
+            async with semaphore:
+                res = await self._run_job(job)
+            # written as jobs finish, a long batch can be inspected early
+            async with lock:
+                with open(results, "a") as f:
+                    f.write(res.model_dump_json() + "\n")
+            logging.info("%s: %s in %.1fs, cost %.4f", job.id, "ok" if res.ok else "failed",
+                         res.duration, res.cost)
+            return res
+
+        return list(await asyncio.gather(*(run_one(job) for job in jobs)))
+
+    async def _run_job(self, job: Job) -> JobResult:
+        directory = self._output.joinpath(job.id)
+        directory.mkdir(parents=True, exist_ok=True)
+        res = JobResult(id=job.id, directory=str(directory))
+        start = time.perf_counter()
+        agent = Agent(model=self._model, api_base=self._api_base, tracer=self._tracer,
+                      workspace=Workspace(directory, job.id), fast_model=self._fast_model,
+                      cache=self._cache, transport=self._transport)
+        try:
+            ret = await agent.aanswer(job.brief, attachment=job.attachment)
+        except Exception as e:
+            # the files written by the failed turn were restored
+            logging.exception("%s failed", job.id)
+            res.error = repr(e)
+        else:
+            res.ok = True
+            res.cost = ret.cost
+            res.retries = ret.retries
+            res.input_tokens = ret.input_tokens
+            res.cached_tokens = ret.cached_tokens
+        res.duration = time.perf_counter() - start
+        res.files = [rel for rel, _ in walk(directory)]
+        return res
+
+def main() -> int:
+    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+    datefmt='%Y-%m-%d %H:%M'
+    logging.basicConfig(level=logging.INFO, format=format, datefmt=datefmt)
+
+    parser = argparse.ArgumentParser(description="run a batch of briefs without the gui")
+    parser.add_argument("jobs", help="json lines file with one brief per line, or a directory of prompt files")
+    parser.add_argument("--output", default="out", help="one working directory per job and results.jsonl")
+    parser.add_argument("--model", default="claude-3-5-sonnet-20240620")
+    parser.add_argument("--api-base")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=5, help="retries of a request after rate limits, overloads and connection errors")
+    parser.add_argument("--backoff", type=float, default=2.0, help="first retry delay in seconds, doubled each time")
+    parser.add_argument("--trace", help="append turn traces to this json lines file")
+    parser.add_argument("--fast-model", help="model tried first for short edit requests")
+    parser.add_argument("--cache", help="response cache database, identical requests are not sent again")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds per model request")
+    args = parser.parse_args()
+
+    jobs = load_jobs(pathlib.Path(args.jobs))
+    output = pathlib.Path(args.output).resolve()
+    output.mkdir(parents=True, exist_ok=True)
+
+    tracer = Tracer([log_exporter])
+    if args.trace:
+        tracer.add_exporter(JsonLinesExporter(args.trace))
+    cache = ResponseCache(pathlib.Path(args.cache)) if args.cache else None
+    transport = Transport(timeout=args.timeout, retries=args.retries, backoff=args.backoff)
+    runner = Runner(output, args.model, api_base=args.api_base, concurrency=args.concurrency, tracer=tracer,
+                    fast_model=args.fast_model, cache=cache, transport=transport)
+    results = asyncio.run(runner.run(jobs))
+    if cache:
+        print(cache.stats.summary())
+    print(transport.stats.summary())
+
+    failed = [r for r in results if not r.ok]
+    print(f"{len(results) - len(failed)}/{len(results)} jobs done, "
+          f"cost {sum(r.cost for r in results):.4f}, results in {output.joinpath(RESULTS_FILE)}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Coroutine
+
+# one event loop in a background thread drives every agent turn. each
+# submitted coroutine returns a future that can be cancelled, which
+# cancels the underlying task.
+class Engine:
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="engine", daemon=True)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        logging.info("stopping engine")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.close()
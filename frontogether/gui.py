@@ -1,30 +1,104 @@
 import sys
-import os
+import asyncio
 import logging
+import concurrent.futures
+import argparse
+import pathlib
 from PySide6.QtWidgets import QApplication, QMainWindow, QWidget
 from PySide6.QtWidgets import QVBoxLayout, QHBoxLayout, QTextEdit
 from PySide6.QtWidgets import QLineEdit, QPushButton, QSplitter
-from PySide6.QtWidgets import QCheckBox, QTreeView, QFileSystemModel
-from PySide6.QtWebEngineWidgets import QWebEngineView
+from PySide6.QtWidgets import QCheckBox, QTreeView, QFileSystemModel, QLabel
 from PySide6.QtGui import QPixmap
-from PySide6.QtCore import Qt, QUrl, QThreadPool, QRunnable, Slot, Signal
-from PySide6.QtCore import QObject, QBuffer, QIODevice
+from PySide6.QtCore import Qt, QUrl, QThreadPool, QRunnable, QTimer, Slot, Signal
+from PySide6.QtCore import QObject
 from frontogether.server import Server
 from frontogether.agent import Agent
-from frontogether.worker import ServerWorker, AgentWorker
+from frontogether.engine import Engine
+from frontogether.lazy import preload
+from frontogether.store import SessionStore
+from frontogether.cache import ResponseCache
+from frontogether.worker import ServerWorker, AgentWorker, AgentWorkerSignals, TraceSignals
+from frontogether.scheduler import Scheduler, Request
+from frontogether.variants import Variants
+from frontogether.tracing import Tracer, JsonLinesExporter, log_exporter
 from frontogether.canvas import Canvas
-
+from frontogether.chat import ChatView
+from frontogether.screenshot import ScreenshotWorker
+from frontogether.viewer import FileViewer
+from frontogether.workspace import Workspace, Workspaces
+from frontogether.transport import Transport
+
+# seconds a cancelled turn gets to finish when a window is closed
+CLOSE_TIMEOUT = 10
+# commands that need the preview server and the web view
+PREVIEW_COMMANDS = ("/open ", "/variants ", "/promote ")
+
+# one window per project. the windows of a process share the engine
+# loop, the thread pool and the web engine, a project only adds its
+# agent, preview server and views.
+class Frontogether:
+    def __init__(self, port: int = 8000, trace_path: str = None, new_session: bool = False,
+                 fast_model: str = None, cache: bool = True):
+        self._port = port
+        self._options = dict(trace_path=trace_path, new_session=new_session,
+                             fast_model=fast_model, cache=cache)
+        self.threadpool = QThreadPool()
+        self.engine = Engine()
+        self.engine.start()
+        # model connections are pooled across projects
+        self.transport = Transport()
+        self._workspaces = Workspaces()
+        self._windows = {}
+
+    def open(self, root: pathlib.Path) -> "FrontogetherGui":
+        workspace = self._workspaces.open(root)
+        window = self._windows.get(workspace.root)
+        if window is None:
+            # the first project gets the requested port, others a free one
+            port = self._port if not self._windows else 0
+            window = FrontogetherGui(self, workspace, port=port, **self._options)
+            self._windows[workspace.root] = window
+        window.show()
+        window.raise_()
+        return window
+
+    def closed(self, window: "FrontogetherGui") -> None:
+        self._windows.pop(window.workspace.root, None)
+        self._workspaces.close(window.workspace)
+        if not self._windows:
+            self.engine.stop()
 
 class FrontogetherGui(QMainWindow):
-    def __init__(self):
+    def __init__(self, app: Frontogether, workspace: Workspace, port: int = 8000, trace_path: str = None,
+                 new_session: bool = False, fast_model: str = None, cache: bool = True):
         super().__init__()
-        self.setWindowTitle("Frontogether")
+        self._app = app
+        self.workspace = workspace
+        self.setWindowTitle(f"Frontogether - {workspace.name}")
         self.setGeometry(100, 100, 1200, 800)
 
-        self._agent = Agent()
-        self._threadpool = QThreadPool()
-        self._server = ServerWorker()
-        self._threadpool.start(self._server)
+        self._trace = TraceSignals()
+        tracer = Tracer([log_exporter, self._trace])
+        if trace_path:
+            tracer.add_exporter(JsonLinesExporter(trace_path))
+        # the last session of this directory is picked up where it stopped
+        self._store = SessionStore(workspace.state("sessions.db"))
+        session = None if new_session else self._store.latest(workspace.root)
+        self._cache = ResponseCache(workspace.state("cache.db")) if cache else None
+        self._agent = Agent(tracer=tracer, store=self._store, session=session, workspace=workspace,
+                            fast_model=fast_model, cache=self._cache, transport=app.transport)
+        self._threadpool = app.threadpool
+        self._engine = app.engine
+        # the server and the web view are started once the window shows
+        self._port = port
+        self._server = None
+        self._web_view = None
+        # turns run one at a time, messages sent meanwhile are merged
+        self._scheduler = Scheduler(self._engine, self._run_turn)
+        self._signals = AgentWorkerSignals()
+        # screenshots being encoded, each with its own message
+        self._screenshots = []
+        self._variants = Variants(workspace, transport=app.transport)
 
         main_splitter = QSplitter(Qt.Horizontal)
         self.setCentralWidget(main_splitter)
@@ -39,10 +113,20 @@ class FrontogetherGui(QMainWindow):
         # chat history
         chat_widget = QWidget()
         chat_layout = QVBoxLayout(chat_widget)
-        self._chat = QTextEdit()
-        self._chat.setReadOnly(True)
+        self._chat = ChatView()
         self.banner()
+        if session is not None:
+            self.insert_text(f"resumed session {session} at turn {self._store.last_turn(session)}")
         chat_layout.addWidget(self._chat)
+        self._signals.content.connect(self.insert_text)
+        self._signals.html.connect(self.insert_html)
+        self._signals.preview.connect(lambda url: self._web_view.load(QUrl(url)))
+
+        # timings of the last turn
+        self._stats = QLabel()
+        self._stats.setWordWrap(True)
+        self._trace.summary.connect(self._stats.setText)
+        chat_layout.addWidget(self._stats)
 
         # chat input
         chat_input_layout = QHBoxLayout()
@@ -53,10 +137,19 @@ class FrontogetherGui(QMainWindow):
         self._send_screen = QCheckBox("attach screenshot")
         chat_input_layout.addWidget(self._send_screen)
 
+        self._crop_screen = QCheckBox("crop to annotations")
+        self._crop_screen.setChecked(True)
+        chat_input_layout.addWidget(self._crop_screen)
+
         send_button = QPushButton("send")
         send_button.clicked.connect(self.send)
         send_button.setShortcut("Ctrl+Return")
         chat_input_layout.addWidget(send_button)
+
+        stop_button = QPushButton("stop")
+        stop_button.clicked.connect(self._scheduler.cancel)
+        stop_button.setShortcut("Escape")
+        chat_input_layout.addWidget(stop_button)
         chat_layout.addLayout(chat_input_layout)
         chat_file_splitter.addWidget(chat_widget)
 
@@ -65,13 +158,12 @@ class FrontogetherGui(QMainWindow):
         file_viewer_layout = QHBoxLayout(file_viewer_widget)
         self._file_tree = QTreeView()
         self._file_tree.setModel(QFileSystemModel())
-        self._file_tree.setRootIndex(self._file_tree.model().setRootPath(os.getcwd()))
+        self._file_tree.setRootIndex(self._file_tree.model().setRootPath(str(workspace.root)))
         self._file_tree.selectionModel().selectionChanged.connect(self.on_file_select)
         file_viewer_layout.addWidget(self._file_tree)
 
-        self._editor = QTextEdit()
-        self._editor.setReadOnly(True)
-        file_viewer_layout.addWidget(self._editor)
+        self._viewer = FileViewer(self._threadpool)
+        file_viewer_layout.addWidget(self._viewer)
         chat_file_splitter.addWidget(file_viewer_widget)
         
         # right pane
@@ -79,14 +171,12 @@ class FrontogetherGui(QMainWindow):
         right_layout = QVBoxLayout(right_widget)
         main_splitter.addWidget(right_widget)
 
-        result_draw_splitter = QSplitter(Qt.Vertical)
+        self._result_draw_splitter = QSplitter(Qt.Vertical)
+        result_draw_splitter = self._result_draw_splitter
         right_layout.addWidget(result_draw_splitter)
 
-        # web view
-        self._web_view = QWebEngineView()
-        result_draw_splitter.addWidget(self._web_view)
-        self._web_view.setZoomFactor(0.25)
-        self._web_view.load(QUrl("http://localhost:8000"))
+        # web view, replaced in _start
+        result_draw_splitter.addWidget(QLabel("starting preview..."))
 
         # canvas
         canvas_widget = QWidget()
@@ -114,9 +204,44 @@ class FrontogetherGui(QMainWindow):
         chat_file_splitter.setSizes([400, 400])
         result_draw_splitter.setSizes([400, 400])
 
+        QTimer.singleShot(0, self._start)
+
+    def _start(self):
+        # runs after the window is shown. litellm is imported in the
+        # background, a turn sent meanwhile waits for it on the engine
+        preload()
+        self._server = ServerWorker(self._port, str(self.workspace.root))
+        # the server holds a pool thread while the window is open
+        self._threadpool.setMaxThreadCount(self._threadpool.maxThreadCount() + 1)
+        self._threadpool.start(self._server)
+        # the preview reloads itself as soon as each file is written
+        self._agent.add_write_listener(self._server.notify)
+        self._variants.add_write_listener(self._server.notify)
+        # and shows pages while they are generated
+        self._agent.add_partial_listener(self._server.notify_partial)
+        self._variants.add_partial_listener(self._server.notify_partial)
+
+        # loading the web engine starts its browser processes
+        from PySide6.QtWebEngineWidgets import QWebEngineView
+        self._web_view = QWebEngineView()
+        self._web_view.setZoomFactor(0.25)
+        self._result_draw_splitter.replaceWidget(0, self._web_view).deleteLater()
+        self._web_view.load(QUrl(self._server.url))
+
     def closeEvent(self, event):
-        logging.info("stopping server")
-        self._server.stop()
+        # the cancelled turn is still recorded, the store is closed after
+        try:
+            self._scheduler.stop().result(CLOSE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            logging.warning("turn of %s did not stop in time", self.workspace.name)
+        logging.info("stopping server of %s", self.workspace.name)
+        if self._server:
+            self._server.stop()
+            self._threadpool.setMaxThreadCount(self._threadpool.maxThreadCount() - 1)
+        self._store.close()
+        if self._cache:
+            self._cache.close()
+        self._app.closed(self)
         event.accept()
 
     def banner(self):
@@ -136,6 +261,9 @@ d88'      d88'     `?8888P'd88'   88b  `?8b  `?8888P'`?88P'`88b`?888P'  `?8b  d8
         self.insert_html(f"<br><div style=\"{banner_style}\"><pre>{b}</pre></div>")
 
     def screenshot(self):
+        if self._web_view is None:
+            self.insert_text("preview is starting")
+            return
         size = self._web_view.contentsRect()
         img = QPixmap(size.width(), size.height())
         self._web_view.render(img)
@@ -148,57 +276,112 @@ d88'      d88'     `?8888P'd88'   88b  `?8b  `?8888P'`?88P'`88b`?888P'  `?8b  d8
         self._canvas.update()
 
     def insert_html(self, msg: str):
-        self._chat.insertHtml(msg)
+        self._chat.append_html(msg)
 
     def insert_text(self, msg: str):
-        self._chat.insertPlainText(msg)
-        self.scroll()
-
-    def scroll(self):
-        sbar = self._chat.verticalScrollBar()
-        sbar.setValue(sbar.maximum())
-
-    def completed(self):
-        self._web_view.load(QUrl("http://localhost:8000"))
+        self._chat.append_text(msg)
 
     def on_file_select(self):
         idx = self._file_tree.selectedIndexes()[0]
         info = self._file_tree.model().fileInfo(idx)
-        path = info.absoluteFilePath()
+        if info.isFile():
+            self._viewer.open(info.absoluteFilePath())
+
+
+    def screenshot_encoded(self, content: str, attachment: str):
+        self._screenshots = [w for w in self._screenshots if w.signals is not self.sender()]
+        self.answer(content, attachment)
+
+    def answer(self, inp: str, attachment: str):
+        if self._scheduler.busy:
+            self.insert_text(f"queued: {inp}")
+        self._scheduler.submit(inp, attachment)
 
+    def variants(self, inp: str):
+        parts = inp.split(" ", 2)
+        if len(parts) < 3 or not parts[1].isdigit() or int(parts[1]) < 1:
+            self.insert_text("usage: /variants N brief")
+            return
+        n, brief = int(parts[1]), parts[2]
+        self._engine.submit(self._run_variants(brief, n))
+
+    async def _run_variants(self, brief: str, n: int):
+        # runs on the engine loop, the copies are made off the gui thread
+        try:
+            results = await self._variants.run(
+                brief, n, ready=lambda: self._signals.preview.emit(self._server.variants_url))
+        except RuntimeError as e:
+            self._signals.content.emit(f"error: {e}")
+            return
+        lines = [r.summary() for r in results]
+        lines.append(f"total cost: {sum(r.cost for r in results):.4f}")
+        self._signals.content.emit("\n" + "\n".join(lines) + "\n")
+
+    def promote(self, inp: str):
+        index = inp.split(" ", 1)[1].strip().lstrip("v")
+        if not index.isdigit():
+            self.insert_text("usage: /promote N")
+            return
+        # queued like a turn, so it does not race the agent
+        self._scheduler.call(lambda: self._promote(int(index)))
+
+    async def _promote(self, index: int):
+        # runs on the engine loop
+        try:
+            paths = await asyncio.to_thread(self._variants.promote, index)
+        except RuntimeError as e:
+            self._signals.content.emit(f"error: {e}")
+            return
+        for path in paths:
+            self._server.notify(path)
+        self._signals.content.emit(f"promoted v{index}: {len(paths)} files")
+        self._signals.preview.emit(self._server.url)
+
+    def project(self, inp: str):
+        # another project in its own window, relative to this one
+        path = self.workspace.root.joinpath(inp.split(" ", 1)[1].strip())
         try:
-            with open(path, "r") as f:
-                self._editor.setPlainText(f.read())
-        except UnicodeDecodeError:
-            self._editor.setPlainText("binary file")
+            self._app.open(path)
+        except RuntimeError as e:
+            self.insert_text(f"error: {e}")
 
+    async def _run_turn(self, request: Request):
+        # runs on the engine loop
+        worker = AgentWorker(self._agent, request.content, request.attachment, self._signals)
+        await worker.run()
 
     def send(self):
         inp = self._chat_input.toPlainText()
 
         if inp.startswith("/"):
-            self._chat.insertPlainText(f"command {inp}")
-            if inp.startswith("/open "):
+            self.insert_text(f"command {inp}")
+            if inp.startswith(PREVIEW_COMMANDS) and self._web_view is None:
+                # created in _start, right after the window shows
+                self.insert_text("preview is starting")
+            elif inp.startswith("/open "):
                 url = inp.lstrip("/open ")
                 self._web_view.load(QUrl(url))
+            elif inp.startswith("/variants "):
+                self.variants(inp)
+            elif inp.startswith("/promote "):
+                self.promote(inp)
+            elif inp.startswith("/project "):
+                self.project(inp)
             else:
-                self._chat.insertPlainText(f"error: invalid command {inp}")
-
-        else:
-            attachment = None
-            if self._send_screen.checkState():
-                buffer = QBuffer()
-                buffer.open(QIODevice.OpenModeFlag.WriteOnly)
-                self._canvas.grab().save(buffer, "PNG")
-                attachment = buffer.data().toBase64().toStdString()
-                self._send_screen.setChecked(False)
-
-            worker = AgentWorker(self._agent, inp, attachment)
-            worker.signals.content.connect(self.insert_text)
-            worker.signals.html.connect(self.insert_html)
-            worker.signals.completed.connect(self.completed)
+                self.insert_text(f"error: invalid command {inp}")
+
+        elif self._send_screen.checkState():
+            # encoding runs off the gui thread, the turn starts when it is done
+            crop = self._canvas.annotation_rect() if self._crop_screen.isChecked() else None
+            worker = ScreenshotWorker(self._canvas.grab().toImage(), crop, inp)
+            worker.signals.encoded.connect(self.screenshot_encoded)
+            # keep the signals alive until delivered
+            self._screenshots.append(worker)
             self._threadpool.start(worker)
+            self._send_screen.setChecked(False)
 
+        else:
+            self.answer(inp, None)
 
         self._chat_input.setText("")
 
@@ -207,7 +390,23 @@ if __name__ == "__main__":
     datefmt='%Y-%m-%d %H:%M'
     logging.basicConfig(level=logging.INFO, format=format, datefmt=datefmt)
 
-    app = QApplication(sys.argv)
-    window = FrontogetherGui()
-    window.show()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("projects", nargs="*", default=["."],
+                        help="project directories, each one opens in its own window")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="preview server port, 0 picks a free one")
+    parser.add_argument("--trace", help="append turn traces to this json lines file")
+    parser.add_argument("--new-session", action="store_true",
+                        help="start a new session instead of resuming the last one")
+    parser.add_argument("--fast-model", help="model tried first for short edit requests")
+    parser.add_argument("--no-cache", action="store_true", help="do not reuse cached responses")
+    args, qt_args = parser.parse_known_args()
+
+    # required when the web engine is loaded after the application
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication(sys.argv[:1] + qt_args)
+    frontogether = Frontogether(port=args.port, trace_path=args.trace, new_session=args.new_session,
+                                fast_model=args.fast_model, cache=not args.no_cache)
+    for project in args.projects:
+        frontogether.open(pathlib.Path(project))
     sys.exit(app.exec())
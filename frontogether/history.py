@@ -0,0 +1,198 @@
+import json
+import logging
+from pydantic import BaseModel
+from typing import List, Any, Dict, Optional, Set, Tuple
+
+# rough estimate, good enough to decide when to compact without
+# running a tokenizer over the whole history every turn
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+STALE_CONTENT = "[replaced by a later write]"
+
+class Turn(BaseModel):
+    index: int
+    content: str
+    brief: str
+    messages: List[Any]
+    image: Optional[str] = None
+    compacted: bool = False
+
+class HistoryStats(BaseModel):
+    compactions: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+def _get(message: Any, key: str) -> Any:
+    if isinstance(message, dict):
+        return message.get(key)
+    return getattr(message, key, None)
+
+def _tool_calls(message: Any) -> List[Any]:
+    return _get(message, "tool_calls") or []
+
+def plain(message: Any) -> Any:
+    if isinstance(message, dict):
+        return message
+    # tool calls collected from the stream are delta objects, which
+    # pydantic does not dump as the declared field type
+    res = {"role": message.role, "content": message.content}
+    if message.tool_calls:
+        res["tool_calls"] = [{
+            "id": tool_call.id,
+            "type": "function",
+            "function": {
+                "name": tool_call.function.name,
+                "arguments": tool_call.function.arguments,
+            },
+        } for tool_call in message.tool_calls]
+    return res
+
+def estimate_tokens(messages: List[Any]) -> int:
+    chars = 0
+    images = 0
+    for m in messages:
+        content = _get(m, "content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    images += 1
+                else:
+                    chars += len(part.get("text", ""))
+        for tool_call in _tool_calls(m):
+            chars += len(tool_call.function.arguments or "")
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+
+class History:
+    def __init__(self, budget: int = 60000, keep_turns: int = 4):
+        self._budget = budget
+        self._keep_turns = keep_turns
+        self._summary: List[str] = []
+        self._turns: List[Turn] = []
+        self.stats = HistoryStats()
+
+    def append(self, turn: Turn) -> None:
+        self._turns.append(turn)
+
+    def state(self) -> Tuple[List[str], List[Turn]]:
+        return list(self._summary), list(self._turns)
+
+    def restore(self, summary: List[str], turns: List[Turn]) -> None:
+        self._summary = list(summary)
+        self._turns = list(turns)
+
+    def messages(self) -> List[Any]:
+        res = []
+        if self._summary:
+            res.append({
+                "role": "user",
+                "content": "summary of previous turns:\n" + "\n".join(self._summary),
+            })
+            res.append({
+                "role": "assistant",
+                "content": "ok",
+            })
+        for turn in self._turns:
+            res += turn.messages
+        return res
+
+    def image_turn(self, image: str) -> Optional[int]:
+        # turn that still carries a screenshot with this digest
+        for turn in reversed(self._turns):
+            if turn.image == image:
+                return turn.index
+        return None
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.messages())
+
+    def compact(self) -> Set[int]:
+        # returns the turns whose file contents were dropped from the
+        # history, the caller must send those files again
+        before = self.tokens()
+        if before <= self._budget:
+            return set()
+
+        old = self._turns[:-self._keep_turns] if self._keep_turns else self._turns
+        dropped = set()
+        for turn in old:
+            if not turn.compacted:
+                self._drop_snapshot(turn)
+                turn.compacted = True
+                dropped.add(turn.index)
+        # superseded writes are not referenced by the workspace snapshot
+        self._drop_stale_writes(old)
+
+        while old and self.tokens() > self._budget:
+            turn = old.pop(0)
+            self._turns.remove(turn)
+            self._summary.append(self._summarize(turn))
+            dropped.add(turn.index)
+
+        after = self.tokens()
+        self.stats.compactions += 1
+        self.stats.tokens_before += before
+        self.stats.tokens_after += after
+        logging.info("history compacted: %d -> %d tokens", before, after)
+        return dropped
+
+    def _drop_snapshot(self, turn: Turn) -> None:
+        # file contents and screenshots are only useful while current
+        for i, m in enumerate(turn.messages):
+            if isinstance(m, dict) and m.get("role") == "user":
+                turn.messages[i] = {"role": "user", "content": turn.brief}
+        turn.image = None
+
+    def _drop_stale_writes(self, turns: List[Turn]) -> None:
+        indexes = {turn.index for turn in turns}
+        writes = []
+        for turn in self._turns:
+            for m in turn.messages:
+                for tool_call in _tool_calls(m):
+                    args = self._write_args(tool_call)
+                    if args:
+                        writes.append((turn, tool_call, args))
+
+        latest = {}
+        for i, (_, _, args) in enumerate(writes):
+            latest[args["filename"]] = i
+
+        for i, (turn, tool_call, args) in enumerate(writes):
+            if turn.index not in indexes or latest[args["filename"]] == i:
+                continue
+            if args.get("content") == STALE_CONTENT:
+                continue
+            args["content"] = STALE_CONTENT
+            tool_call.function.arguments = json.dumps(args)
+
+    def _write_args(self, tool_call: Any) -> Optional[Dict[str, Any]]:
+        if tool_call.function.name != "write_file":
+            return None
+        try:
+            args = json.loads(tool_call.function.arguments)
+        except ValueError:
+            return None
+        if not isinstance(args, dict) or "filename" not in args:
+            return None
+        return args
+
+    def _summarize(self, turn: Turn) -> str:
+        files = []
+        text = ""
+        for m in turn.messages:
+            for tool_call in _tool_calls(m):
+                try:
+                    args = json.loads(tool_call.function.arguments)
+                except ValueError:
+                    continue
+                if isinstance(args, dict) and "filename" in args:
+                    files.append(args["filename"])
+            if _get(m, "role") == "assistant" and _get(m, "content"):
+                text = _get(m, "content")
+        line = f"- turn {turn.index}: {turn.content.strip()}"
+        if files:
+            line += f" (wrote {', '.join(sorted(set(files)))})"
+        if text:
+            line += f"\n  assistant: {text.strip()[:200]}"
+        return line
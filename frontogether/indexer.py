@@ -0,0 +1,180 @@
+import os
+import re
+import fnmatch
+import pathlib
+from pydantic import BaseModel, Field
+from typing import Dict, Iterator, List, Optional, Tuple
+from frontogether.history import CHARS_PER_TOKEN
+
+IGNORE_DIRS = {"node_modules", "__pycache__", "bower_components", "vendor", "dist", "build", "venv"}
+IGNORE_FILES = ("*.min.js", "*.min.css", "*.map", "*.lock", "package-lock.json", "*.pyc")
+BINARY_SUFFIXES = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".bmp", ".avif",
+    ".woff", ".woff2", ".ttf", ".otf", ".eot",
+    ".mp3", ".mp4", ".webm", ".ogg", ".wav",
+    ".pdf", ".zip", ".gz", ".tar", ".wasm", ".db",
+}
+SNIFF_SIZE = 4096
+# larger files are only ever summarized
+MAX_FILE_SIZE = 256 * 1024
+MAX_OUTLINE = 20
+
+OUTLINE_PATTERNS = {
+    "html": re.compile(r"<(title|h[1-3])[^>]*>(.*?)</\1>|\bid=[\"']([\w-]+)", re.I | re.S),
+    "css": re.compile(r"^\s*([^{}@/][^{}]*?)\s*\{", re.M),
+    "js": re.compile(r"\b(?:function\s+(\w+)|class\s+(\w+)|(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s*)?(?:function|\())"),
+    "markdown": re.compile(r"^(#{1,3}\s+.+)$", re.M),
+}
+KINDS = {
+    ".html": "html", ".htm": "html",
+    ".css": "css", ".scss": "css",
+    ".js": "js", ".mjs": "js", ".ts": "js", ".jsx": "js", ".tsx": "js",
+    ".md": "markdown",
+    ".json": "json",
+    ".svg": "svg",
+}
+WORD = re.compile(r"[a-z0-9]{3,}")
+TAG = re.compile(r"<[^>]+>")
+
+class IndexEntry(BaseModel):
+    path: str
+    size: int
+    mtime: float
+    kind: str
+    outline: List[str] = Field(default_factory=list)
+
+    @property
+    def binary(self) -> bool:
+        return self.kind == "binary"
+
+    @property
+    def tokens(self) -> int:
+        return self.size // CHARS_PER_TOKEN
+
+    def summary(self) -> str:
+        res = f"{self.kind}, {self.size} bytes"
+        if self.outline:
+            res += ", outline: " + "; ".join(self.outline)
+        return res
+
+def ignored(path: str) -> bool:
+    parts = pathlib.PurePosixPath(path).parts
+    if any(p.startswith(".") or p in IGNORE_DIRS for p in parts):
+        return True
+    return any(fnmatch.fnmatch(parts[-1], pattern) for pattern in IGNORE_FILES)
+
+def walk(root: pathlib.Path) -> Iterator[Tuple[str, os.stat_result]]:
+    # relative posix paths of the files that belong to the workspace
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d not in IGNORE_DIRS)
+        for f in sorted(files):
+            path = os.path.join(directory, f)
+            rel = pathlib.Path(path).relative_to(root).as_posix()
+            if ignored(rel):
+                continue
+            try:
+                yield rel, os.stat(path)
+            except OSError:
+                continue
+
+def is_binary(path: pathlib.Path) -> bool:
+    # a look at the first bytes, the file is never read in full
+    return path.suffix.lower() in BINARY_SUFFIXES or _sniff(path)
+
+def _sniff(path: pathlib.Path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        return True
+    if b"\0" in head:
+        return True
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # a multibyte character cut at the end of the header is fine
+        return e.start < len(head) - 4
+    return False
+
+def _outline(kind: str, text: str) -> List[str]:
+    res = []
+    if kind == "json":
+        res = re.findall(r'^\s{0,2}"([^"]+)"\s*:', text, re.M)
+    elif kind in OUTLINE_PATTERNS:
+        for match in OUTLINE_PATTERNS[kind].finditer(text):
+            if kind == "html" and match.group(1):
+                heading = TAG.sub(" ", match.group(2))
+                item = f"{match.group(1).lower()}: {heading}"
+            elif kind == "html":
+                item = f"#{match.group(3)}"
+            else:
+                item = next(g for g in match.groups() if g)
+            res.append(" ".join(item.split())[:80])
+    seen = []
+    for item in res:
+        if item not in seen:
+            seen.append(item)
+    return seen[:MAX_OUTLINE]
+
+# cheap description of every workspace file, entries are rebuilt only
+# when the file changes
+class Index:
+    def __init__(self, root: pathlib.Path):
+        self._root = root
+        self._entries: Dict[str, IndexEntry] = {}
+
+    def scan(self) -> Dict[str, IndexEntry]:
+        entries = {}
+        for rel, st in walk(self._root):
+            entry = self._entries.get(rel)
+            if not entry or entry.mtime != st.st_mtime or entry.size != st.st_size:
+                entry = self._entry(rel, st)
+            entries[rel] = entry
+        self._entries = entries
+        return entries
+
+    def _entry(self, rel: str, st: os.stat_result) -> IndexEntry:
+        path = self._root.joinpath(rel)
+        suffix = path.suffix.lower()
+        kind = KINDS.get(suffix, "text")
+        if is_binary(path):
+            kind = "binary"
+        outline = []
+        if kind != "binary" and st.st_size <= MAX_FILE_SIZE:
+            try:
+                outline = _outline(kind, path.read_text(errors="replace"))
+            except OSError:
+                pass
+        return IndexEntry(path=rel, size=st.st_size, mtime=st.st_mtime, kind=kind, outline=outline)
+
+def _words(text: str) -> set:
+    return set(WORD.findall(text.lower()))
+
+def rank(entries: List[IndexEntry], query: str) -> List[IndexEntry]:
+    # keyword overlap with the instruction, then recent edits. the entry
+    # point always comes first.
+    words = _words(query)
+    newest = max((e.mtime for e in entries), default=0.0)
+
+    def score(entry: IndexEntry) -> Tuple[int, float, float]:
+        name = pathlib.PurePosixPath(entry.path).name
+        text = entry.path.replace("/", " ").replace(".", " ") + " " + " ".join(entry.outline)
+        overlap = len(words & _words(text)) + (3 if name.lower() in query.lower() else 0)
+        age = newest - entry.mtime
+        return (1 if entry.path == "index.html" else 0, overlap, -age)
+
+    return sorted(entries, key=score, reverse=True)
+
+def select(entries: List[IndexEntry], query: str, budget: Optional[int]) -> List[IndexEntry]:
+    if budget is None:
+        return [e for e in entries if not e.binary and e.size <= MAX_FILE_SIZE]
+    res = []
+    used = 0
+    for entry in rank(entries, query):
+        if entry.binary or entry.size > MAX_FILE_SIZE:
+            continue
+        if used + entry.tokens > budget:
+            continue
+        res.append(entry)
+        used += entry.tokens
+    return res
@@ -0,0 +1,14 @@
+import threading
+from typing import Any
+
+# litellm takes seconds to import and is only needed once a request is
+# sent, modules get it from here on first use
+
+def litellm() -> Any:
+    import litellm
+    return litellm
+
+def preload() -> None:
+    # imports in the background while the window shows, a first request
+    # sent meanwhile waits for the same import
+    threading.Thread(target=litellm, name="preload", daemon=True).start()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import concurrent.futures
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, List, Optional, Union
+from frontogether.engine import Engine
+
+class Request(BaseModel):
+    content: str
+    attachment: Optional[str] = None
+
+# turns of a session run one at a time on the engine loop. messages sent
+# while a turn is running are queued and, with coalesce, merged into a
+# single follow-up turn. calls that change the workspace are queued the
+# same way so they do not race a turn. all state is only touched from the
+# loop thread, the public methods can be called from any thread.
+class Scheduler:
+    def __init__(self, engine: Engine, run: Callable[[Request], Awaitable[Any]], coalesce: bool = True):
+        self._loop = engine.loop
+        self._run = run
+        self._coalesce = coalesce
+        self._pending: List[Union[Request, Callable[[], Awaitable[Any]]]] = []
+        self._drain_task: Optional[asyncio.Task] = None
+        self._current: Optional[asyncio.Task] = None
+        self._stopped = False
+
+    @property
+    def busy(self) -> bool:
+        return self._current is not None or bool(self._pending)
+
+    def submit(self, content: str, attachment: Optional[str] = None) -> None:
+        request = Request(content=content, attachment=attachment)
+        self._loop.call_soon_threadsafe(self._enqueue, request)
+
+    def call(self, call: Callable[[], Awaitable[Any]]) -> None:
+        # runs between turns, never merged with them
+        self._loop.call_soon_threadsafe(self._enqueue, call)
+
+    def cancel(self) -> None:
+        # stops the running turn, queued requests still run
+        self._loop.call_soon_threadsafe(self._cancel)
+
+    def clear(self) -> None:
+        self._loop.call_soon_threadsafe(self._pending.clear)
+
+    def stop(self) -> concurrent.futures.Future:
+        # drops queued requests and cancels the running turn, the future
+        # is done once the turn has finished
+        return asyncio.run_coroutine_threadsafe(self._stop(), self._loop)
+
+    async def _stop(self) -> None:
+        self._stopped = True
+        self._pending.clear()
+        self._cancel()
+        if self._drain_task is not None:
+            await asyncio.wait([self._drain_task])
+
+    def _enqueue(self, request: Union[Request, Callable[[], Awaitable[Any]]]) -> None:
+        if self._stopped:
+            return
+        self._pending.append(request)
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = self._loop.create_task(self._drain())
+
+    def _cancel(self) -> None:
+        if self._current and not self._current.done():
+            logging.info("cancelling turn")
+            self._current.cancel()
+
+    def _next(self) -> Union[Request, Callable[[], Awaitable[Any]]]:
+        # requests up to the next call are merged
+        n = next((i for i, r in enumerate(self._pending) if not isinstance(r, Request)), len(self._pending))
+        if not self._coalesce or n <= 1:
+            return self._pending.pop(0)
+        requests, self._pending = self._pending[:n], self._pending[n:]
+        attachments = [r.attachment for r in requests if r.attachment]
+        return Request(
+            content="\n\n".join(r.content for r in requests),
+            attachment=attachments[-1] if attachments else None,
+        )
+
+    async def _drain(self) -> None:
+        while self._pending:
+            request = self._next()
+            coro = self._run(request) if isinstance(request, Request) else request()
+            self._current = self._loop.create_task(coro)
+            try:
+                await self._current
+            except asyncio.CancelledError:
+                # only the turn was cancelled, not the scheduler
+                if self._stopped:
+                    raise
+            except Exception:
+                logging.exception("agent turn failed")
+            finally:
+                self._current = None
@@ -0,0 +1,45 @@
+import base64
+import logging
+from PySide6.QtGui import QImage
+from PySide6.QtCore import Qt, QObject, QRunnable, QRect, QBuffer, QIODevice, Signal
+
+# longest side the model uses, larger images are downscaled by the provider
+MAX_SIDE = 1568
+CROP_MARGIN = 48
+JPEG_QUALITY = 85
+
+def _encode(image: QImage, fmt: str, quality: int = -1) -> bytes:
+    buffer = QBuffer()
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, fmt, quality)
+    return bytes(buffer.data())
+
+def encode(image: QImage, crop: QRect = None) -> str:
+    if crop is not None and not crop.isEmpty():
+        rect = crop.adjusted(-CROP_MARGIN, -CROP_MARGIN, CROP_MARGIN, CROP_MARGIN)
+        image = image.copy(rect.intersected(image.rect()))
+
+    if max(image.width(), image.height()) > MAX_SIDE:
+        image = image.scaled(MAX_SIDE, MAX_SIDE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    # screenshots of flat designs are usually smaller as png, photos as jpeg
+    png = _encode(image, "PNG")
+    jpeg = _encode(image.convertToFormat(QImage.Format_RGB888), "JPEG", JPEG_QUALITY)
+    mime, data = ("image/png", png) if len(png) <= len(jpeg) else ("image/jpeg", jpeg)
+    logging.info("screenshot %dx%d %s %d bytes", image.width(), image.height(), mime, len(data))
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+class ScreenshotWorkerSignals(QObject):
+    # the message sent with the screenshot and the encoded image
+    encoded = Signal(str, str)
+
+class ScreenshotWorker(QRunnable):
+    def __init__(self, image: QImage, crop: QRect = None, content: str = ""):
+        super().__init__()
+        self._image = image
+        self._crop = crop
+        self._content = content
+        self.signals = ScreenshotWorkerSignals()
+
+    def run(self):
+        self.signals.encoded.emit(self._content, encode(self._image, self._crop))
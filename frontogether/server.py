@@ -1,23 +1,420 @@
-import http.server
-import socketserver
+import os
+import json
+import errno
+import gzip
+import queue
+import pathlib
+import hashlib
 import logging
+import threading
+import http.server
+import email.utils
+from functools import partial
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Any, Tuple
+from frontogether.workspace import STATE_DIR
+from frontogether.indexer import walk
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-class Server:
+EVENTS_PATH = "/__frontogether/events"
+RELOAD_PATH = "/__frontogether/reload.js"
+RELOAD_JS = pathlib.Path(__file__).parent.joinpath("static", "reload.js").read_bytes()
+RELOAD_TAG = f'<script src="{RELOAD_PATH}"></script>'.encode()
+VARIANTS_PATH = "/__frontogether/variants"
+VARIANTS_DIR = pathlib.Path(STATE_DIR, "variants")
+VARIANTS_HTML = pathlib.Path(__file__).parent.joinpath("static", "variants.html").read_text()
+PARTIAL_PATH = "/__frontogether/partial"
+# the preview is for this machine only
+HOST = "127.0.0.1"
+HEARTBEAT = 15
+WATCH_INTERVAL = 0.5
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+
+class CachedFile(BaseModel):
+    key: tuple
+    body: bytes
+    etag: str
+    last_modified: str
+    content_type: str
+    encoded: Dict[str, bytes] = Field(default_factory=dict)
+
+    def encode(self, encoding: str) -> bytes:
+        if encoding not in self.encoded:
+            if encoding == "br":
+                self.encoded[encoding] = brotli.compress(self.body)
+            else:
+                self.encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+        return self.encoded[encoding]
+
+def _inject(body: bytes) -> bytes:
+    i = body.lower().rfind(b"</body>")
+    if i < 0:
+        return body + RELOAD_TAG
+    return body[:i] + RELOAD_TAG + body[i:]
+
+# files are kept in memory and validated against a stat of the file on
+# every request, so writes from the agent or an editor are picked up
+class FileCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[str, CachedFile] = {}
+
+    def invalidate(self, path: Optional[str] = None) -> None:
+        with self._lock:
+            if path is None:
+                self._files = {}
+            else:
+                self._files.pop(os.path.realpath(path), None)
+
+    def get(self, path: str, content_type: str) -> CachedFile:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._files.get(path)
+        if cached and cached.key == key:
+            return cached
+
+        with open(path, "rb") as f:
+            body = f.read()
+        if content_type == "text/html":
+            body = _inject(body)
+        # skip validation, bodies can be large
+        cached = CachedFile.model_construct(
+            key=key,
+            body=body,
+            etag='"' + hashlib.sha1(body).hexdigest() + '"',
+            last_modified=email.utils.formatdate(st.st_mtime, usegmt=True),
+            content_type=content_type,
+        )
+        with self._lock:
+            self._files[path] = cached
+        return cached
+
+# fan-out of change events to the connected live reload clients
+class Hub:
     def __init__(self):
-        self._port = 8000
-        self._running = True
+        self._lock = threading.Lock()
+        self._clients = []
+
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue()
+        with self._lock:
+            self._clients.append(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue) -> None:
+        with self._lock:
+            self._clients.remove(q)
+
+    def publish(self, event: Optional[Dict[str, Any]]) -> None:
+        with self._lock:
+            for q in self._clients:
+                q.put(event)
+
+    def close(self) -> None:
+        self.publish(None)
+
+# polls the served directory for changes made outside the agent, e.g.
+# by an editor. writes from the agent are reported through notify.
+class Watcher:
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._files = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        # the files of the workspace index, dependencies and build output
+        # are not polled
+        root = pathlib.Path(self._directory)
+        return {str(root.joinpath(rel)): (st.st_mtime_ns, st.st_size) for rel, st in walk(root)}
+
+    def seen(self, path: str) -> None:
+        with self._lock:
+            try:
+                st = os.stat(path)
+                self._files[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                self._files.pop(path, None)
+
+    def changes(self) -> List[str]:
+        files = self._scan()
+        with self._lock:
+            changed = [p for p, key in files.items() if self._files.get(p) != key]
+            changed += [p for p in self._files if p not in files]
+            self._files = files
+        return changed
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, cache: FileCache, hub: Hub, partials: Dict[str, str], **kwargs):
+        self._cache = cache
+        self._hub = hub
+        self._partials = partials
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        logging.debug("server: " + format, *args)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def _serve(self, head: bool):
+        route = self.path.split("?", 1)[0]
+        if route == EVENTS_PATH:
+            return self._events()
+        if route == RELOAD_PATH:
+            return self._reload_js(head)
+        if route == VARIANTS_PATH:
+            return self._variants(head)
+        if route.startswith(PARTIAL_PATH + "/"):
+            return self._partial(route[len(PARTIAL_PATH):], head)
+
+        path = self.translate_path(self.path)
+        if self._private(path):
+            self.send_error(404, "File not found")
+            return
+        if os.path.isdir(path) and self.path.split("?", 1)[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            # directory redirects, listings and 404
+            return super().do_HEAD() if head else super().do_GET()
+
+        try:
+            cached = self._cache.get(path, self.guess_type(path))
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        if self._not_modified(cached):
+            self.send_response(304)
+            self.send_header("ETag", cached.etag)
+            self.send_header("Last-Modified", cached.last_modified)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+
+        body = cached.body
+        encoding = self._encoding(cached)
+        if encoding:
+            body = cached.encode(encoding)
+
+        self.send_response(200)
+        self.send_header("Content-Type", cached.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", cached.etag)
+        self.send_header("Last-Modified", cached.last_modified)
+        # always revalidate, a 304 is cheap
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _private(self, path: str) -> bool:
+        # sessions and caches of the project are not served, the
+        # variant directories are
+        parts = pathlib.PurePath(os.path.relpath(os.path.realpath(path), self.directory)).parts
+        return parts[:1] == (STATE_DIR,) and parts[:2] != VARIANTS_DIR.parts
+
+    def _reload_js(self, head: bool):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/javascript")
+        self.send_header("Content-Length", str(len(RELOAD_JS)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(RELOAD_JS)
+
+    def _variants(self, head: bool):
+        # side by side preview of the directories written by variant runs
+        root = pathlib.Path(self.directory).joinpath(VARIANTS_DIR)
+        names = sorted((p.name for p in root.glob("v*") if p.is_dir() and p.name[1:].isdigit()),
+                       key=lambda n: int(n[1:]))
+        frames = []
+        for name in names:
+            src = "/" + VARIANTS_DIR.joinpath(name).as_posix() + "/"
+            frames.append(f'<section><h2>{name} (/promote {name[1:]})</h2>'
+                          f'<iframe src="{src}" data-dir="{src}"></iframe></section>')
+        body = VARIANTS_HTML.replace("<!-- frames -->", "\n".join(frames)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _partial(self, path: str, head: bool):
+        # the file as generated so far, it is still growing
+        temp = self._partials.get(path)
+        try:
+            with open(temp, "rb") as f:
+                body = f.read()
+        except (OSError, TypeError):
+            self.send_error(404, "File not found")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        # the stream has no length, the connection ends with it
+        self.close_connection = True
+
+        q = self._hub.subscribe()
+        try:
+            while True:
+                try:
+                    event = q.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    self.wfile.write(b": ping\n\n")
+                    self.wfile.flush()
+                    continue
+                if event is None:
+                    break
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self._hub.unsubscribe(q)
+
+    def _not_modified(self, cached: CachedFile) -> bool:
+        etags = self.headers.get("If-None-Match")
+        if etags:
+            return cached.etag in [e.strip() for e in etags.split(",")] or etags.strip() == "*"
+        since = self.headers.get("If-Modified-Since")
+        if since:
+            return since == cached.last_modified
+        return False
+
+    def _encoding(self, cached: CachedFile) -> Optional[str]:
+        if len(cached.body) < COMPRESS_MIN_SIZE:
+            return None
+        if not cached.content_type.startswith(COMPRESS_TYPES):
+            return None
+        accepted = [e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").split(",")]
+        if brotli and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+class Server:
+    def __init__(self, port: int = 8000, directory: Optional[str] = None):
+        self._cache = FileCache()
+        self._hub = Hub()
+        self._directory = os.path.realpath(directory or os.getcwd())
+        self._watcher = Watcher(self._directory)
+        # partial files of writes in progress, by served path
+        self._partials: Dict[str, str] = {}
+        handler = partial(Handler, cache=self._cache, hub=self._hub, partials=self._partials,
+                          directory=self._directory)
+        # bind right away, port 0 picks a free port. another project or
+        # instance on the requested port gets a free one as well
+        try:
+            self._httpd = http.server.ThreadingHTTPServer((HOST, port), handler)
+        except OSError as e:
+            if not port or e.errno != errno.EADDRINUSE:
+                raise
+            logging.warning("port %d is in use, picking a free one", port)
+            self._httpd = http.server.ThreadingHTTPServer((HOST, 0), handler)
+        self._httpd.daemon_threads = True
+        self._port = self._httpd.server_address[1]
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    @property
+    def url(self) -> str:
+        return f"http://{HOST}:{self._port}"
+
+    @property
+    def variants_url(self) -> str:
+        return self.url + VARIANTS_PATH
+
+    def invalidate(self, path: Optional[str] = None) -> None:
+        self._cache.invalidate(path)
+
+    def notify(self, path: str) -> None:
+        # called right after a file is written, before the watcher sees it
+        path = os.path.realpath(path)
+        self._watcher.seen(path)
+        self._changed(path)
+
+    def notify_partial(self, path: str, temp: Optional[str]) -> None:
+        # called while a file is generated, clients can preview it from
+        # PARTIAL_PATH until the final write is notified. temp is None
+        # when the partial file was discarded.
+        rel = os.path.relpath(os.path.realpath(path), self._directory)
+        if rel.startswith(".."):
+            return
+        route = "/" + pathlib.Path(rel).as_posix()
+        if temp is None:
+            # clients show the file as it is on disk again
+            self._partials.pop(route, None)
+            self._hub.publish({"path": route})
+            return
+        self._partials[route] = str(temp)
+        self._hub.publish({"path": route, "partial": True})
+
+    def _changed(self, path: str) -> None:
+        self._cache.invalidate(path)
+        rel = os.path.relpath(path, self._directory)
+        if rel.startswith(".."):
+            return
+        logging.info("changed: %s", rel)
+        route = "/" + pathlib.Path(rel).as_posix()
+        self._partials.pop(route, None)
+        self._hub.publish({"path": route})
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(WATCH_INTERVAL):
+            for path in self._watcher.changes():
+                self._changed(path)
 
     def stop(self):
-        self._running = False
+        self._stopped.set()
+        self._hub.close()
+        if self._running.is_set():
+            self._httpd.shutdown()
+        else:
+            self._httpd.server_close()
 
     def run(self):
         logging.info("running server at port %d", self._port)
-        self._running = True
-        Handler = http.server.SimpleHTTPRequestHandler
-
-        with socketserver.TCPServer(("", self._port), Handler) as httpd:
-            httpd.timeout = 0.5
-            while self._running:
-                httpd.handle_request()
-
+        self._running.set()
+        watcher = threading.Thread(target=self._watch, name="watcher", daemon=True)
+        watcher.start()
+        with self._httpd:
+            self._httpd.serve_forever(poll_interval=0.5)
+        watcher.join()
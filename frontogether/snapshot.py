@@ -0,0 +1,151 @@
+import pathlib
+import hashlib
+import difflib
+import logging
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Set
+from frontogether.indexer import Index, select
+
+class FileEntry(BaseModel):
+    filename: str
+    mtime: float
+    size: int
+    digest: str
+    content: str
+    turn: int
+    # turn that sent the full content, later diffs and edits build on it.
+    # unknown for entries stored before it was tracked
+    base: Optional[int] = None
+
+class FileChange(BaseModel):
+    filename: str
+    # added, changed, unchanged, deleted or summary
+    status: str
+    content: str = ""
+    diff: str = ""
+    turn: int = 0
+
+# workspace state as last sent to the model. entries are validated by
+# mtime and size so unchanged files are not read again, the content hash
+# catches files that were touched but not modified. new and changed files
+# are sent within a token budget, ranked by relevance to the instruction.
+class Snapshot:
+    def __init__(self, root: pathlib.Path):
+        self._root = root
+        self._index = Index(root)
+        self._entries: Dict[str, FileEntry] = {}
+
+    def reset(self) -> None:
+        self._entries = {}
+
+    def forget(self, turns: Set[int]) -> None:
+        # files whose content or diffs were sent in these turns are sent
+        # again in full
+        self._entries = {k: e for k, e in self._entries.items()
+                         if e.base is not None and e.base not in turns and e.turn not in turns}
+
+    def entries(self) -> List[FileEntry]:
+        return list(self._entries.values())
+
+    def digest(self) -> str:
+        # identifies the workspace as known by the model
+        return _digest("\n".join(f"{e.filename} {e.digest}" for e in sorted(
+            self._entries.values(), key=lambda e: e.filename)))
+
+    def restore(self, entries: List[FileEntry]) -> None:
+        self._entries = {e.filename: e for e in entries}
+
+    def record(self, filename: str, content: str, turn: int, edit: bool = False) -> None:
+        # content already known by the model (e.g. it wrote the file). an
+        # edit builds on the full content the model got before, without
+        # it the file is sent in full next turn.
+        entry = self._entries.get(filename)
+        if edit and entry is None:
+            return
+        path = self._root.joinpath(filename)
+        st = path.stat()
+        self._entries[filename] = FileEntry(
+            filename=filename,
+            mtime=st.st_mtime,
+            size=st.st_size,
+            digest=_digest(content),
+            content=content,
+            turn=turn,
+            base=entry.base if edit and entry else turn,
+        )
+
+    def update(self, turn: int, query: str = "", budget: Optional[int] = None) -> List[FileChange]:
+        res = []
+        pending = []
+        index = self._index.scan()
+        for p, info in index.items():
+            entry = self._entries.get(p)
+            if entry and entry.mtime == info.mtime and entry.size == info.size:
+                res.append(FileChange(filename=p, status="unchanged", turn=entry.turn))
+                continue
+            if entry:
+                content = self._read(p)
+                if content is not None and entry.digest == _digest(content):
+                    entry.mtime = info.mtime
+                    entry.size = info.size
+                    res.append(FileChange(filename=p, status="unchanged", turn=entry.turn))
+                    continue
+            pending.append(info)
+
+        # new and changed files compete for the budget, the others are
+        # only described
+        selected = {info.path for info in select(pending, query, budget)}
+        for info in pending:
+            p = info.path
+            entry = self._entries.get(p)
+            content = self._read(p) if p in selected else None
+            if content is None:
+                # what the model knew about the file is outdated now
+                self._entries.pop(p, None)
+                res.append(FileChange(filename=p, status="summary", content=info.summary(), turn=turn))
+                continue
+
+            base = turn
+            if entry:
+                diff = "".join(difflib.unified_diff(
+                    entry.content.splitlines(keepends=True),
+                    content.splitlines(keepends=True),
+                    fromfile=f"a/{p}",
+                    tofile=f"b/{p}",
+                ))
+                if len(diff) < len(content):
+                    res.append(FileChange(filename=p, status="changed", diff=diff, turn=turn))
+                    base = entry.base
+                else:
+                    res.append(FileChange(filename=p, status="changed", content=content, turn=turn))
+            else:
+                res.append(FileChange(filename=p, status="added", content=content, turn=turn))
+
+            self._entries[p] = FileEntry(
+                filename=p,
+                mtime=info.mtime,
+                size=info.size,
+                digest=_digest(content),
+                content=content,
+                turn=turn,
+                base=base,
+            )
+
+        for p in list(self._entries):
+            if p not in index:
+                del self._entries[p]
+                res.append(FileChange(filename=p, status="deleted", turn=turn))
+
+        res.sort(key=lambda c: c.filename)
+        return res
+
+    def _read(self, filename: str) -> Optional[str]:
+        path = self._root.joinpath(filename)
+        try:
+            return path.read_text()
+        except (OSError, UnicodeError):
+            logging.info("skipping file: %s", path)
+            return None
+
+def _digest(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
@@ -0,0 +1,63 @@
+(function () {
+  var key = "frontogether-scroll:" + location.pathname;
+  var saved = sessionStorage.getItem(key);
+  if (saved) {
+    sessionStorage.removeItem(key);
+    var pos = JSON.parse(saved);
+    window.addEventListener("load", function () {
+      window.scrollTo(pos[0], pos[1]);
+    });
+  }
+
+  function page(path) {
+    return path.endsWith("/") ? path + "index.html" : path;
+  }
+
+  function swapCss(path) {
+    var found = false;
+    document.querySelectorAll('link[rel="stylesheet"]').forEach(function (link) {
+      var url = new URL(link.href);
+      if (url.origin === location.origin && url.pathname === path) {
+        url.searchParams.set("v", Date.now());
+        link.href = url.toString();
+        found = true;
+      }
+    });
+    return found;
+  }
+
+  // the page as generated so far, replaced by a reload once it is written
+  var partialSeq = 0;
+  function showPartial(path) {
+    var seq = ++partialSeq;
+    fetch("/__frontogether/partial" + path, { cache: "no-store" })
+      .then(function (r) { return r.ok ? r.text() : null; })
+      .then(function (text) {
+        if (text === null || seq !== partialSeq) {
+          return;
+        }
+        var doc = new DOMParser().parseFromString(text, "text/html");
+        document.body.innerHTML = doc.body.innerHTML;
+      })
+      .catch(function () {});
+  }
+
+  var source = new EventSource("/__frontogether/events");
+  source.onmessage = function (e) {
+    var event = JSON.parse(e.data);
+    if (event.partial) {
+      if (event.path === page(location.pathname)) {
+        showPartial(event.path);
+      }
+      return;
+    }
+    if (event.path.endsWith(".css") && swapCss(event.path)) {
+      return;
+    }
+    if (event.path.endsWith(".html") && event.path !== page(location.pathname)) {
+      return;
+    }
+    sessionStorage.setItem(key, JSON.stringify([window.scrollX, window.scrollY]));
+    location.reload();
+  };
+})();
@@ -0,0 +1,162 @@
+import json
+import time
+import sqlite3
+import hashlib
+import pathlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from frontogether.history import Turn, plain
+from frontogether.lazy import litellm
+from frontogether.snapshot import FileEntry
+
+# strings at least this long are stored once as content addressed blobs,
+# file contents and screenshots repeat a lot across turns
+BLOB_MIN_SIZE = 512
+BLOB_KEY = "$blob"
+
+SCHEMA = """
+create table if not exists blobs (
+    digest text primary key,
+    data blob not null
+);
+create table if not exists sessions (
+    id integer primary key autoincrement,
+    root text not null,
+    created real not null
+);
+create table if not exists events (
+    id integer primary key autoincrement,
+    session integer not null references sessions(id),
+    kind text not null,
+    turn integer not null,
+    payload text not null
+);
+create index if not exists events_session on events(session, kind, id);
+"""
+
+def _turn_payload(turn: Turn) -> Dict[str, Any]:
+    payload = turn.model_dump(exclude={"messages"})
+    payload["messages"] = [plain(m) for m in turn.messages]
+    return payload
+
+class SessionStore:
+    def __init__(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # used from the gui and the engine threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def create(self, root: pathlib.Path) -> int:
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "insert into sessions (root, created) values (?, ?)",
+                (str(root), time.time()),
+            )
+            return cur.lastrowid
+
+    def latest(self, root: pathlib.Path) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute(
+                "select max(id) from sessions where root = ?", (str(root),)
+            ).fetchone()
+        return row[0]
+
+    def append(self, session: int, kind: str, turn: int, payload: Any) -> None:
+        with self._lock, self._db:
+            payload = json.dumps(self._externalize(payload))
+            self._db.execute(
+                "insert into events (session, kind, turn, payload) values (?, ?, ?, ?)",
+                (session, kind, turn, payload),
+            )
+
+    def last_turn(self, session: int) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "select max(turn) from events where session = ? and kind = 'turn'", (session,)
+            ).fetchone()
+        return row[0] or 0
+
+    def append_turn(self, session: int, turn: Turn) -> None:
+        self.append(session, "turn", turn.index, _turn_payload(turn))
+
+    def append_checkpoint(self, session: int, turn: int, summary: List[str], turns: List[Turn]) -> None:
+        # history as left by a compaction, turns before it are not needed
+        # to resume anymore
+        self.append(session, "compact", turn, {
+            "summary": summary,
+            "turns": [_turn_payload(t) for t in turns],
+        })
+
+    def append_snapshot(self, session: int, turn: int, entries: List[FileEntry]) -> None:
+        self.append(session, "snapshot", turn, {"entries": [e.model_dump() for e in entries]})
+
+    def load(self, session: int) -> Tuple[List[str], List[Turn], List[FileEntry]]:
+        # only the latest compaction checkpoint and the turns after it are
+        # read, older events are never loaded again
+        with self._lock:
+            checkpoint = self._db.execute(
+                "select id, payload from events where session = ? and kind = 'compact' "
+                "order by id desc limit 1", (session,)
+            ).fetchone()
+            since = checkpoint[0] if checkpoint else 0
+            turns = self._db.execute(
+                "select payload from events where session = ? and kind = 'turn' and id > ? "
+                "order by id", (session, since)
+            ).fetchall()
+            snapshot = self._db.execute(
+                "select payload from events where session = ? and kind = 'snapshot' "
+                "order by id desc limit 1", (session,)
+            ).fetchone()
+
+            summary = []
+            res = []
+            if checkpoint:
+                history = self._internalize(json.loads(checkpoint[1]))
+                summary = history["summary"]
+                res = [self._turn(t) for t in history["turns"]]
+            res += [self._turn(self._internalize(json.loads(t[0]))) for t in turns]
+            entries = []
+            if snapshot:
+                entries = [FileEntry(**e) for e in self._internalize(json.loads(snapshot[0]))["entries"]]
+        return summary, res, entries
+
+    def _turn(self, payload: Dict[str, Any]) -> Turn:
+        messages = []
+        for m in payload["messages"]:
+            # assistant messages go back to litellm objects, tool calls
+            # are accessed as attributes
+            messages.append(litellm().Message(**m) if m.get("role") == "assistant" else m)
+        payload["messages"] = messages
+        return Turn(**payload)
+
+    def _externalize(self, value: Any) -> Any:
+        if isinstance(value, str) and len(value) >= BLOB_MIN_SIZE:
+            data = value.encode("utf-8", "surrogatepass")
+            digest = hashlib.sha256(data).hexdigest()
+            self._db.execute(
+                "insert or ignore into blobs (digest, data) values (?, ?)", (digest, data)
+            )
+            return {BLOB_KEY: digest}
+        if isinstance(value, dict):
+            return {k: self._externalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._externalize(v) for v in value]
+        return value
+
+    def _internalize(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            if len(value) == 1 and BLOB_KEY in value:
+                row = self._db.execute(
+                    "select data from blobs where digest = ?", (value[BLOB_KEY],)
+                ).fetchone()
+                return row[0].decode("utf-8", "surrogatepass")
+            return {k: self._internalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._internalize(v) for v in value]
+        return value
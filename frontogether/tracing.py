@@ -0,0 +1,95 @@
+import time
+import json
+import logging
+import threading
+import contextlib
+from pydantic import BaseModel, Field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+class Span(BaseModel):
+    name: str
+    start: float
+    duration: float = 0.0
+    attrs: Dict[str, Any] = Field(default_factory=dict)
+
+class Trace(BaseModel):
+    turn: int
+    model: str
+    timestamp: float
+    start: float
+    duration: float = 0.0
+    ttft: Optional[float] = None
+    rounds: int = 0
+    retries: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    error: Optional[str] = None
+    spans: List[Span] = Field(default_factory=list)
+
+    def total(self, name: str) -> float:
+        return sum(s.duration for s in self.spans if s.name == name)
+
+    def summary(self) -> str:
+        parts = [f"turn {self.turn}: {self.duration * 1e3:.0f}ms"]
+        if self.ttft is not None:
+            parts.append(f"ttft {self.ttft * 1e3:.0f}ms")
+        for name in ("read_files", "render", "request", "stream", "tools"):
+            parts.append(f"{name} {self.total(name) * 1e3:.0f}ms")
+        parts.append(f"rounds {self.rounds}")
+        if self.retries:
+            parts.append(f"retries {self.retries}")
+        parts.append(f"tokens {self.input_tokens}/{self.output_tokens} (cached {self.cached_tokens})")
+        parts.append(f"cost {self.cost:.4f}")
+        return " | ".join(parts)
+
+Exporter = Callable[[Trace], None]
+
+# spans are plain timestamps collected on the trace and handed to the
+# exporters once per turn, nothing is done per chunk
+class Tracer:
+    def __init__(self, exporters: Optional[List[Exporter]] = None):
+        self._exporters = list(exporters or [])
+
+    def add_exporter(self, exporter: Exporter) -> None:
+        self._exporters.append(exporter)
+
+    def begin(self, turn: int, model: str) -> Trace:
+        return Trace(turn=turn, model=model, timestamp=time.time(), start=time.perf_counter())
+
+    @contextlib.contextmanager
+    def span(self, trace: Trace, name: str, **attrs: Any) -> Iterator[Span]:
+        span = Span(name=name, start=time.perf_counter() - trace.start, attrs=attrs)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - trace.start - span.start
+            trace.spans.append(span)
+
+    def first_token(self, trace: Trace) -> None:
+        if trace.ttft is None:
+            trace.ttft = time.perf_counter() - trace.start
+
+    def end(self, trace: Trace, error: Optional[BaseException] = None) -> None:
+        trace.duration = time.perf_counter() - trace.start
+        if error is not None:
+            trace.error = repr(error)
+        for exporter in self._exporters:
+            try:
+                exporter(trace)
+            except Exception:
+                logging.exception("trace exporter failed")
+
+class JsonLinesExporter:
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, trace: Trace) -> None:
+        line = json.dumps(trace.model_dump())
+        with self._lock, open(self._path, "a") as f:
+            f.write(line + "\n")
+
+def log_exporter(trace: Trace) -> None:
+    logging.info("%s", trace.summary())
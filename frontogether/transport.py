@@ -0,0 +1,141 @@
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from frontogether.lazy import litellm
+
+T = TypeVar("T")
+
+# statuses of overloaded or briefly unavailable providers, 529 is the
+# anthropic overload error
+RETRY_STATUS = (408, 429, 500, 502, 503, 504, 529)
+
+# a stream that ended before the provider finished the response
+class StreamInterrupted(RuntimeError):
+    pass
+
+class TransportStats(BaseModel):
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+
+    def summary(self) -> str:
+        return f"requests {self.requests}, retries {self.retries}, failed {self.failures}"
+
+# retries are only allowed while they stay a fraction of the requests,
+# during an outage they would otherwise multiply the load. a few are
+# always available after a quiet period.
+class RetryBudget:
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        self._ratio = ratio
+        self._max = float(min_retries)
+        self._balance = float(min_retries)
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._balance = min(self._max, self._balance + self._ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+def retryable(e: BaseException) -> bool:
+    lm = litellm()
+    if isinstance(e, (StreamInterrupted, lm.RateLimitError, lm.ServiceUnavailableError, lm.InternalServerError,
+                      lm.APIConnectionError, lm.Timeout)):
+        return True
+    import httpx
+    # streams broken after the response started are not always mapped
+    if isinstance(e, httpx.TransportError):
+        return True
+    return getattr(e, "status_code", None) in RETRY_STATUS
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    try:
+        return float(e.response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+# every model request goes through here. connections are kept alive in
+# one pooled client per event loop, requests get a timeout and transient
+# errors are retried with jittered exponential backoff.
+class Transport:
+    def __init__(self,
+                 timeout: float = 600.0,
+                 connect_timeout: float = 10.0,
+                 retries: int = 4,
+                 backoff: float = 1.0,
+                 max_backoff: float = 30.0,
+                 max_connections: int = 20,
+                 budget: Optional[RetryBudget] = None):
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._max_connections = max_connections
+        self._budget = budget or RetryBudget()
+        # httpx clients cannot be used across event loops
+        self._clients = weakref.WeakKeyDictionary()
+        self.stats = TransportStats()
+
+    def _client(self) -> Any:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            import httpx
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self._timeout, connect=self._connect_timeout),
+                limits=httpx.Limits(max_connections=self._max_connections,
+                                    max_keepalive_connections=self._max_connections,
+                                    keepalive_expiry=60),
+            )
+            self._clients[loop] = client
+        return client
+
+    async def acompletion(self, **kwargs: Any) -> Any:
+        lm = litellm()
+        # used by the openai compatible providers, the others keep their
+        # own pooled clients inside litellm
+        lm.aclient_session = self._client()
+        self.stats.requests += 1
+        self._budget.deposit()
+        # retries of the provider sdks would multiply with ours
+        return await lm.acompletion(timeout=self._timeout, max_retries=0, **kwargs)
+
+    def delay(self, attempt: int, e: Optional[BaseException] = None) -> float:
+        delay = min(self._max_backoff, self._backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        after = _retry_after(e) if e is not None else None
+        # the provider knows best, within reason
+        return max(delay, min(after, self._max_backoff)) if after is not None else delay
+
+    async def retry(self, attempt: Callable[[], Awaitable[T]],
+                    on_retry: Optional[Callable[[int, float, BaseException], None]] = None) -> T:
+        # attempt is called again from the start, a broken stream cannot
+        # be resumed where it stopped
+        n = 0
+        while True:
+            n += 1
+            try:
+                return await attempt()
+            except Exception as e:
+                if not retryable(e) or n > self._retries:
+                    self.stats.failures += 1
+                    raise
+                if not self._budget.withdraw():
+                    logging.warning("retry budget exhausted, not retrying %s", type(e).__name__)
+                    self.stats.failures += 1
+                    raise
+                delay = self.delay(n, e)
+                self.stats.retries += 1
+                logging.warning("%s, retrying in %.1fs (%d/%d)", type(e).__name__, delay, n, self._retries)
+                if on_retry:
+                    on_retry(n, delay, e)
+                await asyncio.sleep(delay)
@@ -0,0 +1,159 @@
+import time
+import shutil
+import asyncio
+import logging
+import pathlib
+from pydantic import BaseModel
+from typing import Callable, List, Optional
+from frontogether.agent import Agent, _atomic_write
+from frontogether.server import VARIANTS_DIR
+from frontogether.indexer import walk
+from frontogether.tracing import Tracer
+from frontogether.workspace import Workspace
+from frontogether.transport import Transport
+
+class VariantResult(BaseModel):
+    index: int
+    directory: str
+    cost: float = 0.0
+    input_tokens: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+
+    def summary(self) -> str:
+        if self.error:
+            return f"v{self.index}: failed after {self.duration:.1f}s: {self.error}"
+        return f"v{self.index}: cost {self.cost:.4f}, input tokens {self.input_tokens}, {self.duration:.1f}s"
+
+# one brief fanned out to several agents, each working on its own copy of
+# the workspace under .frontogether/variants/vN. the copies are previewed
+# side by side and one of them can be promoted back into the workspace.
+class Variants:
+    def __init__(self,
+                 workspace: Optional[Workspace] = None,
+                 model: str = "claude-3-5-sonnet-20240620",
+                 api_base: Optional[str] = None,
+                 concurrency: int = 3,
+                 tracer: Optional[Tracer] = None,
+                 transport: Optional[Transport] = None):
+        self._workspace = workspace or Workspace.cwd()
+        self._root = self._workspace.root
+        self._dir = self._root.joinpath(VARIANTS_DIR)
+        self._model = model
+        self._api_base = api_base
+        self._concurrency = concurrency
+        self._tracer = tracer
+        self._transport = transport
+        self._write_listeners = []
+        self._partial_listeners = []
+        # files the copies started with, a promoted variant removes the
+        # ones it deleted
+        self._prepared: List[str] = []
+        self._running = False
+
+    def add_write_listener(self, callback: Callable[[pathlib.Path], None]) -> None:
+        self._write_listeners.append(callback)
+
+    def add_partial_listener(self, callback: Callable[[pathlib.Path, Optional[pathlib.Path]], None]) -> None:
+        self._partial_listeners.append(callback)
+
+    def directory(self, index: int) -> pathlib.Path:
+        return self._dir.joinpath(f"v{index}")
+
+    def prepare(self, n: int) -> List[pathlib.Path]:
+        # every variant starts from the current workspace
+        if self._dir.exists():
+            shutil.rmtree(self._dir)
+        files = [rel for rel, _ in walk(self._root)]
+        res = []
+        for i in range(1, n + 1):
+            directory = self.directory(i)
+            directory.mkdir(parents=True)
+            for rel in files:
+                output = directory.joinpath(rel)
+                output.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(self._root.joinpath(rel), output)
+            res.append(directory)
+        self._prepared = files
+        return res
+
+    async def run(self, brief: str, n: int, attachment: Optional[str] = None,
+                  ready: Optional[Callable[[], None]] = None) -> List[VariantResult]:
+        # the copies of a previous run are replaced, not while its agents
+        # still write into them. ready is called once the copies are made.
+        if self._running:
+            raise RuntimeError("variants are still running")
+        self._running = True
+        try:
+            await asyncio.to_thread(self.prepare, n)
+            if ready:
+                ready()
+
+            # the semaphore bounds both the open streams and the spend rate
+            semaphore = asyncio.Semaphore(self._concurrency)
+
+            async def run_one(i: int) -> VariantResult:
+                async with semaphore:
+                    return await self._run_variant(i, n, brief, attachment)
+
+            return list(await asyncio.gather(*(run_one(i) for i in range(1, n + 1))))
+        finally:
+            self._running = False
+
+    async def _run_variant(self, i: int, n: int, brief: str, attachment: Optional[str]) -> VariantResult:
+        directory = self.directory(i)
+        agent = Agent(model=self._model, api_base=self._api_base, tracer=self._tracer,
+                      workspace=Workspace(directory, f"{self._workspace.name}/v{i}"),
+                      transport=self._transport)
+        for callback in self._write_listeners:
+            agent.add_write_listener(callback)
+        for callback in self._partial_listeners:
+            agent.add_partial_listener(callback)
+
+        res = VariantResult(index=i, directory=str(directory))
+        start = time.perf_counter()
+        try:
+            ret = await agent.aanswer(
+                f"{brief}\n\nthis is design variant {i} of {n}, "
+                "make it clearly different from the other variants.",
+                attachment=attachment,
+            )
+            res.cost = ret.cost
+            res.input_tokens = ret.input_tokens
+        except Exception as e:
+            logging.exception("variant %d failed", i)
+            res.error = str(e)
+        res.duration = time.perf_counter() - start
+        return res
+
+    def promote(self, index: int) -> List[pathlib.Path]:
+        # files written and removed, callers run it between turns of the
+        # main agent
+        if self._running:
+            raise RuntimeError("variants are still running")
+        directory = self.directory(index)
+        if not directory.is_dir():
+            raise RuntimeError(f"no such variant: v{index}")
+
+        res = []
+        files = [rel for rel, _ in walk(directory)]
+        for rel in set(self._prepared) - set(files):
+            output = self._root.joinpath(rel)
+            try:
+                output.unlink()
+            except FileNotFoundError:
+                continue
+            res.append(output)
+        for rel in files:
+            p = directory.joinpath(rel)
+            output = self._root.joinpath(rel)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                content = p.read_text()
+            except UnicodeError:
+                shutil.copy2(p, output)
+            else:
+                _atomic_write(output, content)
+            res.append(output)
+        logging.info("promoted variant %d: %d files", index, len(res))
+        return res
@@ -0,0 +1,137 @@
+import os
+import mmap
+import pathlib
+from typing import Tuple
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPlainTextEdit, QPushButton, QLabel
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QFileSystemWatcher, Signal, Slot
+from frontogether.indexer import is_binary
+
+# larger files are shown one page at a time
+PAGE_SIZE = 256 * 1024
+# how far a page may extend to end at a line break
+MAX_LINE_SEARCH = PAGE_SIZE // 4
+
+def _boundary(m: mmap.mmap, offset: int, size: int) -> int:
+    # the first line break after offset when it is near, otherwise offset
+    # moved back to the start of a utf-8 character. pages start and end
+    # at the same boundaries, so they never overlap.
+    if offset <= 0 or offset >= size:
+        return max(0, min(offset, size))
+    nl = m.find(b"\n", offset, min(offset + MAX_LINE_SEARCH, size))
+    if nl >= 0:
+        return nl + 1
+    for _ in range(3):
+        if m[offset] & 0xC0 != 0x80:
+            break
+        offset -= 1
+    return offset
+
+def read_page(path: pathlib.Path, page: int) -> Tuple[str, int, int]:
+    # returns the text of the page, the page actually read and the number
+    # of pages. pages are cut at line breaks, a line belongs to the page
+    # it starts in. very long lines, e.g. in minified bundles, are cut.
+    size = path.stat().st_size
+    if is_binary(path):
+        return f"binary file, {size} bytes", 0, 1
+    if size <= PAGE_SIZE:
+        return path.read_text(errors="replace"), 0, 1
+
+    pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        start = _boundary(m, page * PAGE_SIZE, size)
+        end = _boundary(m, (page + 1) * PAGE_SIZE, size)
+        return m[start:end].decode("utf-8", errors="replace"), page, pages
+
+class FileLoaderSignals(QObject):
+    loaded = Signal(int, str, int, int)
+
+class FileLoader(QRunnable):
+    def __init__(self, generation: int, path: pathlib.Path, page: int):
+        super().__init__()
+        self._generation = generation
+        self._path = path
+        self._page = page
+        self.signals = FileLoaderSignals()
+
+    def run(self):
+        try:
+            text, page, pages = read_page(self._path, self._page)
+        except (OSError, ValueError) as e:
+            text, page, pages = f"cannot read file: {e}", 0, 1
+        self.signals.loaded.emit(self._generation, text, page, pages)
+
+# read-only view of a workspace file. files are read on the thread pool,
+# results of loads that were superseded by a newer one are dropped.
+class FileViewer(QWidget):
+    def __init__(self, threadpool: QThreadPool):
+        super().__init__()
+        self._threadpool = threadpool
+        self._path = None
+        self._page = 0
+        self._generation = 0
+        self._loaders = {}
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self._text = QPlainTextEdit()
+        self._text.setReadOnly(True)
+        self._text.setUndoRedoEnabled(False)
+        layout.addWidget(self._text)
+
+        pager = QHBoxLayout()
+        self._prev = QPushButton("previous")
+        self._prev.clicked.connect(lambda: self._load(self._page - 1))
+        pager.addWidget(self._prev)
+        self._label = QLabel()
+        pager.addWidget(self._label)
+        self._next = QPushButton("next")
+        self._next.clicked.connect(lambda: self._load(self._page + 1))
+        pager.addWidget(self._next)
+        self._pager = QWidget()
+        self._pager.setLayout(pager)
+        self._pager.hide()
+        layout.addWidget(self._pager)
+
+        # the agent replaces files atomically, the path is watched again
+        # after every load
+        self._watcher = QFileSystemWatcher()
+        self._watcher.fileChanged.connect(self._changed)
+
+    def open(self, path: str):
+        if self._watcher.files():
+            self._watcher.removePaths(self._watcher.files())
+        self._path = pathlib.Path(path)
+        self._text.setPlainText("loading...")
+        self._load(0)
+
+    def _load(self, page: int):
+        self._generation += 1
+        loader = FileLoader(self._generation, self._path, page)
+        loader.signals.loaded.connect(self._loaded)
+        # keep the signals alive until delivered
+        self._loaders[self._generation] = loader
+        self._threadpool.start(loader)
+
+    @Slot(int, str, int, int)
+    def _loaded(self, generation: int, text: str, page: int, pages: int):
+        self._loaders.pop(generation, None)
+        if generation != self._generation:
+            return
+        # a refresh of the same page keeps the scroll position
+        bar = self._text.verticalScrollBar()
+        position = bar.value() if page == self._page else 0
+        self._page = page
+        self._text.setPlainText(text)
+        bar.setValue(position)
+        self._pager.setVisible(pages > 1)
+        self._label.setText(f"page {page + 1}/{pages}")
+        self._prev.setEnabled(page > 0)
+        self._next.setEnabled(page < pages - 1)
+        if os.path.exists(self._path) and str(self._path) not in self._watcher.files():
+            self._watcher.addPath(str(self._path))
+
+    @Slot(str)
+    def _changed(self, path: str):
+        if self._path and path == str(self._path):
+            self._load(self._page)
@@ -1,12 +1,30 @@
+import time
+import asyncio
+from typing import Any, Callable, Optional
 from PySide6.QtCore import Qt, QObject, QThreadPool, QRunnable, Signal
 
 from frontogether.agent import Agent
 from frontogether.server import Server
+from frontogether.tracing import Trace
 
 class ServerWorker(QRunnable):
-    def __init__(self):
+    def __init__(self, port: int = 8000, directory: Optional[str] = None):
         super().__init__()
-        self._server = Server()
+        self._server = Server(port=port, directory=directory)
+
+    @property
+    def url(self) -> str:
+        return self._server.url
+
+    @property
+    def variants_url(self) -> str:
+        return self._server.variants_url
+
+    def notify(self, path: str) -> None:
+        self._server.notify(path)
+
+    def notify_partial(self, path: str, temp: Optional[str]) -> None:
+        self._server.notify_partial(path, temp)
 
     def stop(self):
         self._server.stop()
@@ -14,14 +32,51 @@ class ServerWorker(QRunnable):
     def run(self):
         self._server.run()
 
+class TraceSignals(QObject):
+    summary = Signal(str)
+
+    def __call__(self, trace: Trace) -> None:
+        # exporter called from the engine thread, delivered queued
+        self.summary.emit(trace.summary())
+
 class AgentWorkerSignals(QObject):
     content = Signal(str)
     html = Signal(str)
-    completed = Signal()
+    # url for the preview to load
+    preview = Signal(str)
 
-class AgentWorker(QRunnable):
-    def __init__(self, agent: Agent, content: str, attachment: str):
-        super().__init__()
+# streamed deltas are buffered and emitted at most once per frame, the
+# GUI thread would otherwise get one queued signal per chunk. used on
+# the engine loop, a timer emits the rest when no more deltas arrive.
+class Coalescer:
+    def __init__(self, emit: Callable[[str], None], fps: int = 30):
+        self._emit = emit
+        self._interval = 1.0 / fps
+        self._parts = []
+        self._last = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, msg: str) -> None:
+        self._parts.append(msg)
+        wait = self._interval - (time.monotonic() - self._last)
+        if wait <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(wait, self.flush)
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._parts:
+            self._emit("".join(self._parts))
+            self._parts = []
+        self._last = time.monotonic()
+
+# one turn of the agent, run by the scheduler on the engine loop. the
+# signals are shared by all turns of a session and live in the GUI thread.
+class AgentWorker:
+    def __init__(self, agent: Agent, content: str, attachment: str, signals: AgentWorkerSignals):
         self._agent = agent
         self._content = content
         self._attachment = attachment
@@ -30,7 +85,8 @@ class AgentWorker(QRunnable):
         self._user_style = "background-color: #bfffba; color: #050707; font-weight: bold;"
         self._assistant_style = "background-color: #ffc980; color: #2d4b4b; font-weight: bold;"
         self._tool_style = "background-color: #f6baff; color: #2d4b4b; font-weight: bold;"
-        self.signals = AgentWorkerSignals()
+        self.signals = signals
+        self._text = Coalescer(self.signals.content.emit)
 
     def _preffix(self, style: str) -> str:
         return f"<br><hr><span style=\"{style}\">"
@@ -38,27 +94,52 @@ class AgentWorker(QRunnable):
     def _suffix(self) -> str:
         return "</span><br><br>"
 
-    def run(self):
+    def _html(self, msg: str) -> None:
+        # keep ordering with the buffered text
+        self._text.flush()
+        self.signals.html.emit(msg)
+
+    async def run(self):
         def progress_callback(msg: str):
             if self._first_content:
-                self.signals.html.emit(f"{self._preffix(self._assistant_style)}[ assistant ]{self._suffix()}")
+                self._html(f"{self._preffix(self._assistant_style)}[ assistant ]{self._suffix()}")
                 self._first_content = False
-            self.signals.content.emit(msg)
+            self._text.add(msg)
 
         def progress_tool_callback(msg: str):
             if self._first_tool:
-                self.signals.html.emit(f"{self._preffix(self._tool_style)}[ tool ]{self._suffix()}")
+                self._html(f"{self._preffix(self._tool_style)}[ tool ]{self._suffix()}")
                 self._first_tool = False
                 self._first_content = True
-            self.signals.content.emit(msg)
+            self._text.add(msg)
+
+        def finished_callback(msg: Any):
+            self._text.flush()
 
-        self.signals.html.emit(f"{self._preffix(self._user_style)}[ user ]{self._suffix()}")
+        self._html(f"{self._preffix(self._user_style)}[ user ]{self._suffix()}")
         self.signals.content.emit(self._content)
 
-        resp = self._agent.answer(self._content,
-            attachment=self._attachment,
-            progress_callback=progress_callback,
-            progress_tool_callback=progress_tool_callback,
-        )
+        try:
+            resp = await self._agent.aanswer(self._content,
+                attachment=self._attachment,
+                progress_callback=progress_callback,
+                progress_tool_callback=progress_tool_callback,
+                finished_callback=finished_callback,
+            )
+        except asyncio.CancelledError:
+            self._html(f"{self._preffix(self._tool_style)}[ cancelled ]{self._suffix()}")
+            raise
+        except Exception as e:
+            # files written by the turn were restored by the agent
+            self._html(f"{self._preffix(self._tool_style)}[ failed ]{self._suffix()}")
+            self.signals.content.emit(f"{type(e).__name__}: {e}\nthe files written by this turn were restored")
+            raise
+        finally:
+            self._text.flush()
         self.signals.content.emit(f"\n\ncost: {resp.cost}")
-        self.signals.completed.emit()
+        self.signals.content.emit(f"\ninput tokens: {resp.input_tokens} (cached: {resp.cached_tokens}, uncached: {resp.uncached_tokens})")
+        self.signals.content.emit(f"\nmodel: {resp.model}" + (" (escalated)" if resp.escalations else ""))
+        if resp.retries:
+            self.signals.content.emit(f"\nretries: {resp.retries}")
+        if self._agent.cache:
+            self.signals.content.emit(f"\n{self._agent.cache.stats.summary()}")
@@ -0,0 +1,91 @@
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+# sessions, the response cache, variants and partial writes of a project
+STATE_DIR = ".frontogether"
+
+# a project directory. the agent, the preview server and the file tree
+# of a window all work on the workspace they are given, never on the
+# process cwd, so one process can host several projects.
+class Workspace:
+    def __init__(self, root: pathlib.Path, name: Optional[str] = None):
+        self.root = pathlib.Path(root).resolve()
+        self.name = name or self.root.name or str(self.root)
+
+    def __repr__(self) -> str:
+        return f"Workspace({self.name!r}, {str(self.root)!r})"
+
+    def state(self, *parts: str) -> pathlib.Path:
+        return self.root.joinpath(STATE_DIR, *parts)
+
+    @classmethod
+    def cwd(cls) -> "Workspace":
+        return cls(pathlib.Path.cwd())
+
+# the workspaces open in this process, at most one per directory. names
+# are unique, projects with the same directory name get a suffix.
+class Workspaces:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open: Dict[pathlib.Path, Workspace] = {}
+
+    def open(self, root: pathlib.Path) -> Workspace:
+        root = pathlib.Path(root).resolve()
+        if not root.is_dir():
+            raise RuntimeError(f"not a directory: {root}")
+        with self._lock:
+            if root in self._open:
+                return self._open[root]
+            names = {w.name for w in self._open.values()}
+            workspace = Workspace(root)
+            name = workspace.name
+            i = 2
+            while workspace.name in names:
+                workspace.name = f"{name}-{i}"
+                i += 1
+            self._open[root] = workspace
+            return workspace
+
+    def close(self, workspace: Workspace) -> None:
+        with self._lock:
+            self._open.pop(workspace.root, None)
+
+# contents of the files a turn writes, as they were before its first
+# write. a failed turn is rolled back so the workspace matches the
+# history, which does not include it.
+class Journal:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._saved: Dict[pathlib.Path, Optional[bytes]] = {}
+
+    def save(self, path: pathlib.Path) -> None:
+        with self._lock:
+            if path in self._saved:
+                return
+            try:
+                self._saved[path] = path.read_bytes()
+            except FileNotFoundError:
+                self._saved[path] = None
+
+    def rollback(self) -> List[pathlib.Path]:
+        with self._lock:
+            saved, self._saved = self._saved, {}
+        for path, data in saved.items():
+            if data is None:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                continue
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return list(saved)
@@ -0,0 +1,42 @@
+from frontogether.history import History, Turn
+from frontogether.snapshot import Snapshot
+
+def _turn(index: int) -> Turn:
+    return Turn(index=index, content="c", brief="c",
+                messages=[{"role": "user", "content": "x" * 8000}, {"role": "assistant", "content": "ok"}])
+
+def test_diff_is_sent_in_full_after_its_base_is_compacted(tmp_path):
+    page = tmp_path.joinpath("index.html")
+    lines = [f"<p>line {i}</p>\n" for i in range(200)]
+    page.write_text("".join(lines))
+    snapshot = Snapshot(tmp_path)
+    history = History(budget=3000, keep_turns=1)
+
+    assert [c.status for c in snapshot.update(1)] == ["added"]
+    history.append(_turn(1))
+
+    lines[10] = "<p>changed</p>\n"
+    page.write_text("".join(lines))
+    changes = snapshot.update(2)
+    assert changes[0].status == "changed" and changes[0].diff
+    history.append(_turn(2))
+
+    dropped = history.compact()
+    assert dropped == {1}
+    snapshot.forget(dropped)
+
+    # the full content of turn 1 is gone, the diff of turn 2 builds on it
+    changes = snapshot.update(3)
+    assert changes[0].status == "added"
+    assert changes[0].content == page.read_text()
+
+def test_edit_builds_on_the_full_content(tmp_path):
+    page = tmp_path.joinpath("index.html")
+    page.write_text("<p>a</p>")
+    snapshot = Snapshot(tmp_path)
+    snapshot.update(1)
+    page.write_text("<p>b</p>")
+    snapshot.record("index.html", "<p>b</p>", 2, edit=True)
+
+    snapshot.forget({1})
+    assert snapshot.entries() == []